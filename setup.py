@@ -47,7 +47,7 @@ setuptools.setup(
     },
     license='GPLv3',
     # add modules
-    py_modules = ['tempo120'],
+    py_modules = ['tempo120', 'tempo120_env', 'tempo120_net'],
     packages = ['gfx','muzak','scores'],
     package_data = {
         'gfx': ['*'],
@@ -59,7 +59,7 @@ setuptools.setup(
             'tempo120 = tempo120:main'
         ]
     },
-    install_requires = [ "pygame==2.6.0" ],
+    install_requires = [ "pygame==2.6.0", "numpy" ],
     # see https://pypi.org/classifiers/
     classifiers=[
         "Development Status :: 7 - Inactive",
@@ -70,6 +70,6 @@ setuptools.setup(
         "Intended Audience :: End Users/Desktop",
         "Topic :: Games/Entertainment"
     ],
-    python_requires='>=2.7, <4',
+    python_requires='>=3.8, <4',
 )
 
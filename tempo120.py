@@ -20,9 +20,21 @@ __status__     = "Production"
 
 # --- imports ---------------------------------------------------------------
 from random import random
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import hashlib
+import json
 import os
 import sys
 import math
+import mmap
+import struct
+import time
+import zipfile
+import numpy as np
 import pygame
 import pygame.gfxdraw
 from pygame.locals import *
@@ -34,12 +46,55 @@ VIEW_WIDTH = 40
 VIEW_HEIGHT = 25
 SCR_WIDTH = VIEW_WIDTH * SIZE
 SCR_HEIGHT = VIEW_HEIGHT * SIZE
+CHUNK_SIZE = 1024
+MAX_CHUNKS = 16
+TRACK_CHUNK = 256
+MAX_TRACK_CHUNKS = 64
+TILED_TRACK_MAGIC = b"T120TILE"
+TILED_TRACK_ALIGN = 65536
+SPRITE_RESOLUTION = 1.
+LOADER_THREADS = 4
+PHYSICS_HZ = 60
+FPS = 60
+MAX_FRAME_TIME = .25
+PROFILE_FRAMES = 1024
+TEXT_CACHE = 64
+DEFAULT_TRACK = "track01"
+CHECKPOINTS = 8
+MAX_PROGRESS_JUMP = 8
+WRONG_WAY_TILES = 4
+MAX_DISTANCE = 8
+RACING_LINE_SMOOTHING = 9
+RACING_LINE_LOOKAHEAD = 8
+BRAKE_TILES = 20
+CURVE_SLOWDOWN = 20.
+NPC_MIN_SPEED = 3.
+NPC_MAX_SPEED = 12.
+NPC_ROW_TILES = 2
+NPC_COLUMN_GAP = 48
+NPC_STEER_TOLERANCE = 2.
+NPC_SKILL = (.8, 1.)
+NPC_TINT = (120, 160, 255, 255)
+NPC_RECOVERY_STEPS = 30
+TRACE_OVERSHOOT = .01
+REPLAY_MAGIC = b"T120REPL"
+REPLAY_HEADER = "<8sHHIiI"
+GHOST_ALPHA = 120
+MAX_PLAYERS = 4
+PLAYER_GAP = 40
+PLAYER_TINTS = [(255, 255, 255, 255), (255, 90, 90, 255), (90, 255, 90, 255), (150, 150, 150, 255)]
+RENDER_SCALE = 1.
+MINIMAP_SIZE = 160
+MINIMAP_MARGIN = 20
+MINIMAP_SAMPLES = 4
+MINIMAP_MARKER = 6
 
 INTRO_TITLE = 0
 INTRO_SCORES = 1
 BEGIN = 2
 GAME = 3
 SET_SCORE = 4
+LOADING = 5
 
 TILE_TRACK = (139, 139, 139, 255)
 TILE_GRASS = (100, 255, 0, 255)
@@ -47,6 +102,37 @@ TILE_GOAL = (255, 255, 255, 255)
 TILE_START = (255, 0, 0, 255)
 TILE_TIRES = (0, 0, 0, 255)
 
+FLOOR_TRACK = 0
+FLOOR_GRASS = 1
+FLOOR_GOAL = 2
+FLOOR_START = 3
+FLOOR_TIRES = 4
+FLOOR_COLORS = [TILE_TRACK, TILE_GRASS, TILE_GOAL, TILE_START, TILE_TIRES]
+MINIMAP_COLORS = [(200, 200, 200), (30, 70, 0), (255, 255, 255), (200, 200, 200), (0, 0, 0)]
+DISTANCE_FLOORS = [FLOOR_GRASS, FLOOR_GOAL, FLOOR_TIRES]
+
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_UP = 4
+INPUT_DOWN = 8
+
+PLAYER_KEYS = [
+    (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN),
+    (pygame.K_a, pygame.K_d, pygame.K_w, pygame.K_s),
+    (pygame.K_j, pygame.K_l, pygame.K_i, pygame.K_k),
+    (pygame.K_KP4, pygame.K_KP6, pygame.K_KP8, pygame.K_KP5)]
+
+PHASE_EVENTS = 0
+PHASE_KEYS = 1
+PHASE_STEP = 2
+PHASE_TRACK = 3
+PHASE_HUD = 4
+PHASE_UPDATE = 5
+PHASE_IDLE = 6
+PHASE_NAMES = ["events", "keys", "step", "track", "hud", "update", "idle"]
+PHASE_COLORS = [(255, 255, 0), (255, 128, 0), (255, 0, 0), (0, 160, 255), (0, 255, 160), (255, 0, 255),
+    (96, 96, 96)]
+
  
 
 # --- helper methods --------------------------------------------------------
@@ -77,76 +163,977 @@ def nice_time(t):
     return "%02d:%02d:%02d.%03d" % (hours, minutes, seconds, millis)
 
 
+def get_render_size(render_scale):
+    """Returns the size of the tiles and the one of the screen at the given render scale
+
+    The tiles' size is rounded to whole pixels, so that the screen shows the
+    same part of the track at all scales.
+    """
+    tile_size = min(SIZE, max(1, int(round(SIZE * render_scale))))
+    return tile_size, (VIEW_WIDTH * tile_size, VIEW_HEIGHT * tile_size)
+
+
+def subtract_rect(rect, cover):
+    """Returns the parts of the rectangle that are not covered by the other one
+
+    The parts are up to four rectangles (above, below, left and right of the
+    covered part).
+    """
+    clip = rect.clip(cover)
+    if clip.width==0 or clip.height==0:
+        return [rect]
+    parts = []
+    if clip.top>rect.top:
+        parts.append(Rect(rect.left, rect.top, rect.width, clip.top-rect.top))
+    if clip.bottom<rect.bottom:
+        parts.append(Rect(rect.left, clip.bottom, rect.width, rect.bottom-clip.bottom))
+    if clip.left>rect.left:
+        parts.append(Rect(rect.left, clip.top, clip.left-rect.left, clip.height))
+    if clip.right<rect.right:
+        parts.append(Rect(clip.right, clip.top, rect.right-clip.right, clip.height))
+    return parts
+
+
+def get_viewports(players, width=SCR_WIDTH, height=SCR_HEIGHT):
+    """Returns the screen's parts (Rects) the players' views are shown in
+
+    Two players share the screen side by side, three or four get a quarter
+    each.
+    """
+    if players<=1:
+        return [Rect(0, 0, width, height)]
+    if players==2:
+        return [Rect(0, 0, width//2, height), Rect(width//2, 0, width-width//2, height)]
+    w, h = width//2, height//2
+    return [Rect(0, 0, w, h), Rect(w, 0, width-w, h), Rect(0, h, w, height-h),
+        Rect(w, h, width-w, height-h)][:players]
+
+
+def decode_track(image, palette=None):
+    """Decodes a track image into a grid of floor codes and a palette
+
+    The returned grid is a (height, width) uint8 array, indexed [y, x]. The
+    known tile colours are mapped onto the FLOOR_* codes, further colours
+    (decorations) get the codes following them and behave like the track.
+    palette[code] is the colour of the code. If a palette is given, the codes
+    of its colours are kept and new colours are appended to it.
+    """
+    if image.get_bytesize()!=4:
+        converted = pygame.Surface(image.get_size(), 0, 32)
+        converted.blit(image, (0, 0))
+        image = converted
+    # the mapped pixel values, indexed [y, x]
+    pixels = pygame.surfarray.pixels2d(image).view(np.uint32).T
+    palette = palette if palette is not None else list(FLOOR_COLORS)
+    colors = np.array([image.map_rgb(c) & 0xffffffff for c in palette], dtype=np.uint32)
+    grid = np.full(pixels.shape, 255, dtype=np.uint8)
+    for code, color in enumerate(colors):
+        np.copyto(grid, np.uint8(code), where=(pixels==color))
+    unknown = grid==255
+    if unknown.any():
+        others, codes = np.unique(pixels[unknown], return_inverse=True)
+        if len(palette)+len(others)>255:
+            raise ValueError("The track image uses too many colors.")
+        grid[unknown] = codes + len(palette)
+        palette.extend(tuple(image.unmap_rgb(int(o))) for o in others)
+    del pixels
+    return grid, palette
+
+
+def flood(passable, seeds):
+    """Computes the number of steps needed to reach each tile from the seeds
+
+    A step goes to a horizontally or vertically adjacent passable tile (a
+    breadth-first search). passable and seeds are boolean arrays of the
+    grid's shape. Tiles that cannot be reached get -1. The result is stored
+    as int16 if the largest number of steps (plus one, see compute_progress)
+    fits, otherwise as int32.
+    """
+    h, w = passable.shape
+    # a border of blocked tiles keeps the neighbours of the flat indices in the grid
+    padded = np.zeros((h+2, w+2), dtype=bool)
+    padded[1:-1, 1:-1] = passable
+    padded = padded.ravel()
+    distances = np.full(len(padded), -1, dtype=np.int32)
+    ys, xs = np.nonzero(seeds)
+    frontier = ((ys+1)*(w+2) + xs+1).astype(np.intp)
+    distances[frontier] = 0
+    offsets = np.array([-1, 1, -(w+2), w+2], dtype=np.intp)
+    distance = 0
+    while len(frontier):
+        distance += 1
+        frontier = (frontier[:, None] + offsets).ravel()
+        frontier = np.unique(frontier[padded[frontier] & (distances[frontier]<0)])
+        distances[frontier] = distance
+    distances = distances.reshape(h+2, w+2)[1:-1, 1:-1]
+    if distance<np.iinfo(np.int16).max:
+        return distances.astype(np.int16)
+    return np.ascontiguousarray(distances)
+
+
+def compute_progress(grid, starts):
+    """Computes the distance along the track of each tile
+
+    The distance is the number of steps between horizontally or vertically
+    adjacent tiles needed to reach the tile from the start positions, driving
+    on the track only (not on grass, tires or the goal). The goal tiles get
+    the largest distance plus one, the track's length. Tiles that cannot be
+    reached this way get -1.
+    """
+    passable = (grid!=FLOOR_GRASS) & (grid!=FLOOR_TIRES) & (grid!=FLOOR_GOAL)
+    seeds = np.zeros(grid.shape, dtype=bool)
+    for x, y in starts:
+        seeds[y, x] = passable[y, x]
+    progress = flood(passable, seeds)
+    progress[grid==FLOOR_GOAL] = progress.max() + 1
+    return progress
+
+
+def get_behind_goal(grid, progress):
+    """Returns the tiles next to the goal that belong to the track's first half
+
+    On a circuit, these are the tiles right behind the goal, where a new lap
+    begins. There are none on a track that is driven from the start to a
+    goal that does not lead back to it (see is_circuit).
+    """
+    goal = grid==FLOOR_GOAL
+    near = np.zeros(grid.shape, dtype=bool)
+    near[1:] |= goal[:-1]
+    near[:-1] |= goal[1:]
+    near[:, 1:] |= goal[:, :-1]
+    near[:, :-1] |= goal[:, 1:]
+    return near & (progress>=0) & (progress<progress.max()//2)
+
+
+def is_circuit(grid, progress):
+    """Returns whether the track's goal leads back to the start
+
+    Vehicles that drive a further lap of a track that is no circuit start
+    it at their start position again (see Simulation.cross_goal).
+    """
+    return bool(get_behind_goal(grid, progress).any())
+
+
+def compute_racing_line(grid, progress):
+    """Computes the racing line and its target speeds
+
+    The tiles' distances to the goal are computed first (see flood), driving
+    on the track. On a circuit, the tiles right behind the goal (having a
+    small progress) are blocked, so that the distances are measured along
+    the lap. The racing line's point i is the centre of the tiles at the
+    distance i, smoothed over RACING_LINE_SMOOTHING points; point 0 is the
+    goal's centre.
+
+    The target speed at a point falls with the line's curvature there and
+    is the lowest one of the next BRAKE_TILES points, so that the vehicles
+    brake before curves.
+
+    Returns the distances to the goal (-1 if the goal cannot be reached),
+    the points in pixels and the target speeds in pixels per step.
+    """
+    goal = grid==FLOOR_GOAL
+    behind = get_behind_goal(grid, progress)
+    passable = (grid!=FLOOR_GRASS) & (grid!=FLOOR_TIRES) & ~goal & ~behind
+    remaining = flood(passable, goal)
+    ys, xs = np.nonzero(remaining>=0)
+    values = remaining[ys, xs]
+    n = int(values.max()) + 1 if len(values) else 1
+    counts = np.maximum(np.bincount(values, minlength=n), 1)
+    line = np.stack((np.bincount(values, weights=xs+.5, minlength=n) / counts,
+        np.bincount(values, weights=ys+.5, minlength=n) / counts), axis=1) * SIZE
+    kernel = np.ones(RACING_LINE_SMOOTHING) / RACING_LINE_SMOOTHING
+    pad = RACING_LINE_SMOOTHING // 2
+    line = np.stack([np.convolve(np.pad(line[:, i], pad, mode="edge"), kernel, mode="valid")
+        for i in range(2)], axis=1)
+    # the change of the line's direction per tile
+    ahead = np.maximum(np.arange(n)-RACING_LINE_LOOKAHEAD//2, 0)
+    delta = line[ahead] - line
+    heading = np.arctan2(delta[:, 0], delta[:, 1])
+    turn = (heading[ahead] - heading + math.pi) % (2*math.pi) - math.pi
+    curvature = np.abs(turn) / (RACING_LINE_LOOKAHEAD//2)
+    speeds = np.maximum(NPC_MIN_SPEED, NPC_MAX_SPEED / (1 + CURVE_SLOWDOWN*curvature))
+    braking = speeds.copy()
+    for i in range(1, BRAKE_TILES+1):
+        braking[i:] = np.minimum(braking[i:], speeds[:-i])
+    return remaining, line.astype(np.float32), braking.astype(np.float32)
+
+
+def compute_distances(grid, limit=MAX_DISTANCE):
+    """Computes the distances of each tile to the nearest grass, goal and tire tiles
+
+    The distances are measured in tiles along the larger of both axes (the
+    Chebyshev distance) and limited to limit. Returns an array of the shape
+    (len(DISTANCE_FLOORS), height, width), one field per floor type.
+    """
+    distances = np.zeros((len(DISTANCE_FLOORS),) + grid.shape, dtype=np.uint8)
+    for field, floor in zip(distances, DISTANCE_FLOORS):
+        reached = grid==floor
+        # a tile's distance is the number of growths needed to reach it
+        for distance in range(limit):
+            field += ~reached
+            if distance==limit-1:
+                break
+            # grow the reached tiles by one tile in all eight directions
+            rows = reached.copy()
+            rows[1:] |= reached[:-1]
+            rows[:-1] |= reached[1:]
+            reached = rows.copy()
+            reached[:, 1:] |= rows[:, :-1]
+            reached[:, :-1] |= rows[:, 1:]
+    return distances
+
+
+def render_minimap(grid, size, colors=MINIMAP_COLORS):
+    """Renders the grid of floor codes into an image of at most size x size pixels
+
+    Each pixel shows the lowest floor code among up to MINIMAP_SAMPLES x
+    MINIMAP_SAMPLES tiles of the part of the track it covers, so that narrow
+    roads (FLOOR_TRACK) do not vanish between the grass. The grid is only
+    sampled, so tiled tracks are not read completely.
+    """
+    height, width = grid.shape
+    step = max(1., max(width, height) / float(size))
+    w = max(1, int(width / step))
+    h = max(1, int(height / step))
+    samples = min(MINIMAP_SAMPLES, int(math.ceil(step)))
+    floors = None
+    for sy in range(samples):
+        ys = np.minimum(((np.arange(h) + (sy + .5) / samples) * step).astype(np.intp), height-1)
+        for sx in range(samples):
+            xs = np.minimum(((np.arange(w) + (sx + .5) / samples) * step).astype(np.intp), width-1)
+            sampled = grid[np.repeat(ys, w), np.tile(xs, h)].reshape(h, w)
+            floors = sampled if floors is None else np.minimum(floors, sampled)
+    image = pygame.image.frombuffer(np.ascontiguousarray(floors, dtype=np.uint8).tobytes(), (w, h), "P")
+    image.set_palette(colors)
+    return image
+
+
+def convert_track(image, path, chunk=TRACK_CHUNK):
+    """Converts a track image into a tiled track file (see ChunkedGrid)
+
+    The image is decoded in strips of chunk rows, so that only one strip's
+    floor codes are held in memory besides the image.
+    """
+    if chunk<=0 or chunk%64!=0:
+        raise ValueError("The chunk size must be a positive multiple of 64.")
+    width, height = image.get_size()
+    ncx = (width + chunk - 1) // chunk
+    ncy = (height + chunk - 1) // chunk
+    palette = list(FLOOR_COLORS)
+    start_positions = []
+    with open(path + ".tmp", "wb") as fd:
+        fd.seek(TILED_TRACK_ALIGN)
+        for cy in range(ncy):
+            h = min(chunk, height - cy*chunk)
+            strip, palette = decode_track(image.subsurface((0, cy*chunk, width, h)), palette)
+            ys, xs = np.nonzero(strip==FLOOR_START)
+            start_positions.extend((int(x), int(y) + cy*chunk) for x, y in zip(xs, ys))
+            strip[ys, xs] = FLOOR_TRACK
+            padded = np.zeros((chunk, ncx*chunk), dtype=np.uint8)
+            padded[:h, :width] = strip
+            fd.write(padded.reshape(chunk, ncx, chunk).transpose(1, 0, 2).tobytes())
+        header = json.dumps({"width": width, "height": height, "chunk": chunk,
+            "palette": [list(c) for c in palette], "start_positions": start_positions}).encode("utf-8")
+        if len(TILED_TRACK_MAGIC)+4+len(header)>TILED_TRACK_ALIGN:
+            raise ValueError("The track's header is too large.")
+        fd.seek(0)
+        fd.write(TILED_TRACK_MAGIC + struct.pack("<I", len(header)) + header)
+    os.replace(path + ".tmp", path)
+
+
+def get_data_path():
+    """Returns the folder that contains the assets (gfx, muzak) and the scores
+
+    That is the module's folder if installed, the current one otherwise.
+    """
+    path = os.path.dirname(__file__)
+    if not os.path.exists(os.path.join(path, "gfx", "car.png")):
+        path = "."
+    return path
+
+
+def get_cache_dir():
+    """Returns the directory compiled assets are stored in
+
+    That's the one given by the TEMPO120_CACHE environment variable or a
+    "tempo120" folder within the user's cache directory.
+    """
+    path = os.environ.get("TEMPO120_CACHE")
+    if path:
+        return path
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "tempo120")
+
+
+def get_cache_path(cache_dir, path, suffix, extra=""):
+    """Returns the path of the compiled version of the given asset
+
+    The name is built from the asset's content, the game's version and the
+    given extra information, so that changing any of them yields a new file.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(1<<20), b""):
+            digest.update(block)
+    key = "%s|%s|%s" % (__version__, digest.hexdigest(), extra)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + suffix)
+
+
+def write_file(path, write):
+    """Writes a file atomically using the given function
+
+    The function gets a temporary file, opened in binary mode, which replaces
+    the given file when it is complete. The temporary file is removed if
+    writing fails.
+    """
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        with open(tmp, "wb") as fd:
+            write(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_cache_file(path, write):
+    """Writes a cache file atomically using the given function (see write_file)
+
+    Failures are reported but not raised as the game runs without its cache
+    as well.
+    """
+    try:
+        write_file(path, write)
+    except OSError as e:
+        print("Could not write the cache file '%s': %s" % (path, e), file=sys.stderr)
+
+
+def save_compiled_track(track, path):
+    """Saves the track's floor grid, palette, start positions, progress and distance fields and racing line
+
+    The arrays are stored compressed into a cache file (see write_cache_file).
+    """
+    write_cache_file(path, lambda fd: np.savez_compressed(fd, grid=track._grid,
+        palette=np.array(track._palette, dtype=np.uint8).reshape(-1, 4),
+        start_positions=np.array(track._start_positions, dtype=np.int64).reshape(-1, 2),
+        progress=track._progress, distances=track._distances, remaining=track._remaining,
+        racing_line=track._racing_line, speeds=track._speeds))
+
+
+def load_compiled_track(path, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS):
+    """Loads a track from a cache file written by save_compiled_track
+
+    Returns None if the file does not exist or is broken.
+    """
+    try:
+        with np.load(path) as data:
+            return Track(None, chunk_size, max_chunks, data["grid"],
+                [tuple(c) for c in data["palette"].tolist()],
+                [tuple(p) for p in data["start_positions"].tolist()], data["progress"], data["distances"],
+                (data["remaining"], data["racing_line"], data["speeds"]))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def is_tiled_track(path):
+    """Returns whether the given file is a tiled track file (see convert_track)"""
+    with open(path, "rb") as fd:
+        return fd.read(len(TILED_TRACK_MAGIC))==TILED_TRACK_MAGIC
+
+
+def load_track(path, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS, max_track_chunks=MAX_TRACK_CHUNKS,
+        cache_dir=None):
+    """Loads a track from an image or from a tiled track file
+
+    A tiled track file (see convert_track) is memory-mapped and its chunks are
+    read when needed, at most max_track_chunks at a time; a warning is
+    printed as such a track has no progress and distance fields (see
+    Track). A track image is
+    compiled into the given cache directory when loaded first, later loads
+    read the compiled version. The compiled version also depends on the
+    constants the distance fields and the racing line are computed with.
+    """
+    if is_tiled_track(path):
+        print("'%s' is a tiled track: the races are not validated, the vehicles' movements are not traced"
+            " and there are no opponents." % path, file=sys.stderr)
+        grid = ChunkedGrid(path, max_track_chunks)
+        return Track(None, chunk_size, max_chunks, grid, grid._palette, grid._start_positions)
+    if cache_dir is None:
+        return Track(pygame.image.load(path), chunk_size, max_chunks)
+    parameters = (SIZE, DISTANCE_FLOORS, MAX_DISTANCE, RACING_LINE_SMOOTHING, RACING_LINE_LOOKAHEAD,
+        BRAKE_TILES, CURVE_SLOWDOWN, NPC_MIN_SPEED, NPC_MAX_SPEED)
+    cache_path = get_cache_path(cache_dir, path, ".npz", parameters)
+    track = load_compiled_track(cache_path, chunk_size, max_chunks)
+    if track is None:
+        track = Track(pygame.image.load(path), chunk_size, max_chunks)
+        save_compiled_track(track, cache_path)
+    return track
+
+
+def load_sound(path, cache_dir=None):
+    """Loads a sound
+
+    The decoded samples are stored in the given cache directory when the sound
+    is loaded first, later loads read them instead of decoding the file. The
+    mixer must be initialised.
+    """
+    if cache_dir is None:
+        return pygame.mixer.Sound(path)
+    cache_path = get_cache_path(cache_dir, path, ".pcm", pygame.mixer.get_init())
+    try:
+        with open(cache_path, "rb") as fd:
+            return pygame.mixer.Sound(buffer=fd.read())
+    except OSError:
+        pass
+    sound = pygame.mixer.Sound(path)
+    write_cache_file(cache_path, lambda fd: fd.write(sound.get_raw()))
+    return sound
+
+
 # --- game classes ----------------------------------------------------------
 class Scores:
     """
-    A class that reads, writes, and processes the high score table.
+    A class that reads, writes, and processes the high score tables.
     
-    Each entry consists of the player's name with a maximum length of 16 characters and 
-    the needed time to accmplish the track in milliseconds. Within the high scores file
-    "scores.txt" each entry is stored in one line, using tab ('\t') to divide the name 
-    and the time.
-    
-    The list may include up to 15 entries. The player's name may be up to 16 characters
-    long.
+    Each entry consists of the player's name with a maximum length of 16 characters,
+    the needed time to accmplish the track in milliseconds and the track's name.
+    Within the high scores file "scores.txt" each entry is stored in one line, using
+    tab ('\t') to divide the name, the time and the track. Entries without a track
+    (as written by former versions) belong to the default track.
+
+    The file is only appended to, one line per entry, so that several game
+    instances may add entries at the same time; refresh reads the entries the
+    other instances have added since. Lines that cannot be parsed are skipped.
+    save rewrites the file atomically, sorted and without the skipped lines.
+
+    All entries are kept, sorted by time, per track. Besides, the best time of
+    each player is kept per track, for ranking the players. The table shows
+    the best 15 entries of the current track. The player's name may be up to 16
+    characters long.
+
+    The replays (see Replay) of the entries are stored in "scores/replays",
+    named after the track, the time and the player.
     """
     
-    def __init__(self, path):
-        """Loads the scores using the load method."""
+    def __init__(self, path, track=DEFAULT_TRACK):
+        """Loads the scores using the load method.
+
+        track is the name of the track the table is shown for.
+        """
         self._path = path
+        self._track = track
         self.load()
         
 
+    def get_file_name(self):
+        """Returns the path of the scores file"""
+        return os.path.join(self._path, "scores", "scores.txt")
+
+
+    def get_replay_dir(self):
+        """Returns the path of the directory the replays are stored in"""
+        return os.path.join(self._path, "scores", "replays")
+
+
+    def get_replay_file_name(self, name, t, track=None):
+        """Returns the path of the replay of the given entry"""
+        track = self._track if track is None else track
+        player = hashlib.md5(name.encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.get_replay_dir(), "%s-%010d-%s.t120r" % (track, t, player))
+
+
+    def get_replays(self, track=None):
+        """Returns the paths of the stored replays of the track, the fastest first"""
+        prefix = (self._track if track is None else track) + "-"
+        try:
+            names = os.listdir(self.get_replay_dir())
+        except OSError:
+            return []
+        names = [name for name in names if name.startswith(prefix) and name.endswith(".t120r")
+            and name[len(prefix):len(prefix)+10].isdigit()]
+        return [os.path.join(self.get_replay_dir(), name) for name in sorted(names)]
+
+
     def load(self):
         """Loads the scores.
         
-        Loads scores from "scores.txt", sorts them by the needed time and prunes
-        them to the maximum length of 15 entries.
+        Loads all entries from "scores.txt" and sorts them by the needed time.
+        """
+        self._entries = {}
+        self._times = {}
+        self._best = {}
+        self._best_times = {}
+        self._offset = 0
+        self._pending = b""
+        self._corrupt = 0
+        self._image = None
+        entries = []
+        for entry in self._read():
+            entries.append(entry)
+        entries.sort(key=lambda x: x[1])
+        for name, t, track in entries:
+            self._entries.setdefault(track, []).append([name, t])
+            self._times.setdefault(track, []).append(t)
+            best = self._best.setdefault(track, {})
+            if name not in best:
+                best[name] = t
+        for track, best in self._best.items():
+            self._best_times[track] = sorted(best.values())
+
+
+    def refresh(self):
+        """Adds the entries appended to the file since it was read
+
+        Returns whether entries were added.
+        """
+        added = False
+        for entry in self._read():
+            self._insert(*entry)
+            added = True
+        return added
+
+
+    def _read(self):
+        """Yields the entries stored behind the already read part of the file
+
+        Only complete lines are read, a trailing part is kept until its line
+        is complete.
+        """
+        try:
+            with open(self.get_file_name(), "rb") as fd:
+                fd.seek(self._offset)
+                data = fd.read()
+        except OSError:
+            return
+        self._offset += len(data)
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            entry = self._parse(line)
+            if entry is not None:
+                yield entry
+
+
+    def _parse(self, line):
+        """Returns the entry (name, time, track) stored in the given line
+
+        Returns None for empty lines; corrupt lines are counted and skipped.
         """
-        scores = []
+        line = line.rstrip(b"\r")
+        if not line.strip():
+            return None
         try:
-            with open(os.path.join(self._path, "scores", "scores.txt")) as fd:
-                for l in fd:
-                    name, t = l.strip().split("\t")
-                    scores.append([name, int(t)])
-            scores.sort(key=lambda x: x[1])
-        except: pass
-        self._scores = scores[:15]
+            fields = line.decode("utf-8").split("\t")
+            if len(fields)==2:
+                fields.append(DEFAULT_TRACK)
+            name, t, track = fields
+            return name, int(t), track
+        except ValueError:
+            self._corrupt += 1
+            return None
+
+
+    def _insert(self, name, t, track):
+        """Inserts an entry into the sorted lists"""
+        times = self._times.setdefault(track, [])
+        i = bisect.bisect_right(times, t)
+        times.insert(i, t)
+        self._entries.setdefault(track, []).insert(i, [name, t])
+        if track==self._track:
+            self._image = None
+        best = self._best.setdefault(track, {})
+        best_times = self._best_times.setdefault(track, [])
+        if name in best:
+            if best[name]<=t:
+                return
+            del best_times[bisect.bisect_left(best_times, best[name])]
+        best[name] = t
+        bisect.insort(best_times, t)
         
         
     def save(self):
-        """Saves the scores into "scores.txt"
+        """Rewrites "scores.txt" atomically (see write_file), sorted by track and time
+
+        Entries appended by other instances while saving are lost.
         """
-        fd = open(os.path.join(self._path, "scores", "scores.txt"), "w")
-        for s in self._scores:
-            fd.write("%s\t%s\n" % (s[0], s[1]))    
-        fd.close()
+        lines = ["%s\t%s\t%s\n" % (name, t, track)
+            for track in sorted(self._entries) for name, t in self._entries[track]]
+        write_file(self.get_file_name(), lambda fd: fd.write("".join(lines).encode("utf-8")))
+        self.load()
 
 
-    def add(self, name, t):
+    def add(self, name, t, track=None, replay=None):
         """Adds an entry to the scores
         
-        The name is added and the scores are sorted by time and pruned to
-        the maximum length of 15 entries.
+        The entry is appended to the file using a single write and inserted
+        into the table of its track (the current one by default). The run's
+        replay is saved if given. Returns the entry's position within the
+        track's entries (1 is the best).
+        """
+        if track is None:
+            track = self._track
+        name = " ".join(name.replace("\t", " ").splitlines())
+        t = int(t)
+        self.refresh()
+        line = "%s\t%s\t%s\n" % (name, t, track)
+        # a line left incomplete by a crashed instance is terminated first,
+        # using surplus fields, so that it is skipped as corrupt
+        if self._pending:
+            line = "\t\t\n" + line
+        os.makedirs(os.path.dirname(self.get_file_name()), exist_ok=True)
+        fd = os.open(self.get_file_name(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+        if replay is not None:
+            replay._name = name
+            replay.save(self.get_replay_file_name(name, t, track))
+        self.refresh()
+        return bisect.bisect_left(self._times[track], t) + 1
+
+
+    def get_top(self, n=15, track=None):
+        """Returns the best n entries ([name, time]) of the track"""
+        return self._entries.get(self._track if track is None else track, [])[:n]
+
+
+    def get_leaderboard(self, n=15, track=None):
+        """Returns the n best players ([name, time]) of the track"""
+        best = self._best.get(self._track if track is None else track, {})
+        return sorted(([name, t] for name, t in best.items()), key=lambda x: x[1])[:n]
+
+
+    def get_best(self, name, track=None):
+        """Returns the player's best time on the track or None"""
+        return self._best.get(self._track if track is None else track, {}).get(name)
+
+
+    def get_rank(self, name, track=None):
+        """Returns the player's rank (1 is the best) on the track or None
+
+        Players with the same best time share the rank.
         """
-        scores = []
-        scores.append([name, t])
-        scores.extend(self._scores)
-        scores.sort(key=lambda x: x[1])
-        self._scores = scores[:15]
-        self.save()
+        track = self._track if track is None else track
+        t = self.get_best(name, track)
+        if t is None:
+            return None
+        return bisect.bisect_left(self._best_times[track], t) + 1
 
 
-    def draw(self, surface, font):
+    def draw(self, surface, font, scale=1.):
         """Draws the scores onto the given surface
+
+        The table is rendered once into an image that is kept until the
+        scores change. Its layout is scaled by the given render scale.
         """
+        if self._image is None or self._image_font is not font:
+            self._image = self.render(font, scale)
+            self._image_font = font
+        return surface.blit(self._image, (0, int(40*scale)))
+
+
+    def render(self, font, scale=1.):
+        """Renders the table into a transparent image
+
+        The image starts at the table's top (y=40). As the texts are white,
+        the transparent background is white, too, so that blitting the image
+        equals blitting the texts.
+        """
+        scores = self.get_top()
+        width = int(SCR_WIDTH*scale)
+        image = pygame.Surface((width, int((60 + len(scores)*40)*scale)), pygame.SRCALPHA)
+        image.fill((255, 255, 255, 0))
         img = font.render("Scores", True, (255, 255, 255))
-        surface.blit(img, ((SCR_WIDTH-img.get_width())/2, 40))
-        for i,s in enumerate(self._scores):
+        image.blit(img, ((width-img.get_width())/2, 0))
+        for i,s in enumerate(scores):
             img = font.render(s[0], True, (255, 255, 255))
-            surface.blit(img, (300, 100 + i*40))
+            image.blit(img, (int(300*scale), int((60 + i*40)*scale)))
             img = font.render(nice_time(s[1]), True, (255, 255, 255))
-            surface.blit(img, (SCR_WIDTH-300-img.get_width(), 100 + i*40))
+            image.blit(img, (width-int(300*scale)-img.get_width(), int((60 + i*40)*scale)))
+        return image
+
+
+
+class TextCache:
+    """
+    A cache of rendered texts.
+
+    Texts that do not change each frame (as the messages or the entered name)
+    are rendered once; at most size texts are kept, the least recently used
+    ones are dropped.
+    """
+
+    def __init__(self, font, color=(255, 255, 255), size=TEXT_CACHE):
+        """Initialises the cache"""
+        self._font = font
+        self._color = color
+        self._size = size
+        self._texts = OrderedDict()
+
+
+    def get(self, text):
+        """Returns the image of the given text"""
+        img = self._texts.get(text)
+        if img is not None:
+            self._texts.move_to_end(text)
+            return img
+        img = self._font.render(text, True, self._color)
+        self._texts[text] = img
+        while len(self._texts)>self._size:
+            self._texts.popitem(last=False)
+        return img
+
+
+
+
+class GlyphCache:
+    """
+    Rendered characters of a font.
+
+    Texts that change each frame (as the speed and the time) are drawn by
+    blitting the images of their characters side by side instead of
+    rendering them anew. The characters are rendered when first needed.
+    Kerning is not applied.
+    """
+
+    def __init__(self, font, color=(255, 255, 255), chars="0123456789.: "):
+        """Initialises the cache, rendering the given characters"""
+        self._font = font
+        self._color = color
+        self._glyphs = {}
+        for char in chars:
+            self.get(char)
+
+
+    def get(self, char):
+        """Returns the image of the given character"""
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            glyph = self._font.render(char, True, self._color)
+            self._glyphs[char] = glyph
+        return glyph
+
+
+    def get_width(self, text):
+        """Returns the width of the given text in pixels"""
+        return sum(self.get(char).get_width() for char in text)
+
+
+    def draw(self, surface, text, pos):
+        """Draws the text at the given position
+
+        Returns the rectangle that was drawn.
+        """
+        x, y = pos
+        for char in text:
+            glyph = self.get(char)
+            if char!=" ":
+                surface.blit(glyph, (x, y))
+            x += glyph.get_width()
+        return Rect(pos[0], y, x-pos[0], self._font.get_height())
+
+
+
+
+class TrackRenderCache:
+    """
+    A cache of pre-rendered track chunks.
+
+    The track is rasterised lazily into square chunks of chunk_size/SIZE tiles,
+    drawn tile_size pixels large (SIZE unless the track is drawn scaled down,
+    see get_render_size). At most max_chunks chunks are kept, the least
+    recently used ones are dropped. Drawing the track means blitting the (up to
+    four) chunks that intersect the view.
+
+    The chunks are rendered from the track's floor grid and palette. The result
+    equals the one of drawing the tiles as filled polygons: as those include
+    their right and bottom edges, the last tile column and row of the track
+    reach one pixel further. The chunks at the track's border are one pixel
+    larger for this reason.
+    """
+
+    def __init__(self, grid, palette, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS, tile_size=SIZE):
+        """Initialises the cache
+        """
+        if chunk_size<=0 or chunk_size%SIZE!=0:
+            raise ValueError("The chunk size must be a positive multiple of %s." % SIZE)
+        self._grid = grid
+        self._palette = palette
+        self._height, self._width = grid.shape
+        self._tile_size = tile_size
+        self._chunk_tiles = chunk_size // SIZE
+        self._chunk_size = self._chunk_tiles * tile_size
+        self._max_chunks = max(1, max_chunks)
+        self._chunks = OrderedDict()
+
+
+    def get_chunk(self, cx, cy, surface=None):
+        """Returns the chunk at the given chunk index, building it if needed
+
+        If a surface is given, a newly built chunk is converted into its pixel
+        format so that blitting it is fast.
+        """
+        key = (cx, cy)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+        tx0 = cx * self._chunk_tiles
+        ty0 = cy * self._chunk_tiles
+        tw = min(self._chunk_tiles, self._width - tx0)
+        th = min(self._chunk_tiles, self._height - ty0)
+        tiles = self._grid[ty0:ty0+th, tx0:tx0+tw]
+        pixels = np.repeat(np.repeat(tiles, self._tile_size, axis=0), self._tile_size, axis=1)
+        # the last tile column / row reaches one pixel further
+        bw = 1 if tx0+tw==self._width else 0
+        bh = 1 if ty0+th==self._height else 0
+        if bw or bh:
+            pixels = np.pad(pixels, ((0, bh), (0, bw)), mode="edge")
+        h, w = pixels.shape
+        chunk = pygame.image.frombuffer(pixels.tobytes(), (w, h), "P")
+        chunk.set_palette(self._palette)
+        if surface is not None:
+            chunk = chunk.convert(surface)
+        self._chunks[key] = chunk
+        while len(self._chunks)>self._max_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+
+    def draw(self, surface, view):
+        """Draws the part of the track that is within the given view
+        """
+        right = self._width * self._tile_size
+        bottom = self._height * self._tile_size
+        # the border is only visible if the last tile column / row is
+        if view.left<right:
+            right += 1
+        if view.top<bottom:
+            bottom += 1
+        x0 = max(0, view.left)
+        y0 = max(0, view.top)
+        x1 = min(right, view.right)
+        y1 = min(bottom, view.bottom)
+        if x0>=x1 or y0>=y1:
+            return
+        cs = self._chunk_size
+        max_cx = (self._width - 1) // self._chunk_tiles
+        max_cy = (self._height - 1) // self._chunk_tiles
+        for cy in range(y0//cs, min(max_cy, (y1-1)//cs)+1):
+            cy0 = cy * cs
+            ay0 = max(y0, cy0)
+            ay1 = y1 if cy==max_cy else min(y1, cy0+cs)
+            for cx in range(x0//cs, min(max_cx, (x1-1)//cs)+1):
+                cx0 = cx * cs
+                ax0 = max(x0, cx0)
+                ax1 = x1 if cx==max_cx else min(x1, cx0+cs)
+                chunk = self.get_chunk(cx, cy, surface)
+                surface.blit(chunk, (ax0-view.left, ay0-view.top), (ax0-cx0, ay0-cy0, ax1-ax0, ay1-ay0))
+
+
+
+
+class ChunkedGrid:
+    """
+    A grid of floor codes that is read from a tiled track file when needed.
+
+    The file (see convert_track) starts with a header (magic, length, JSON
+    with the track's size, chunk size, palette and start positions), followed
+    by the floor codes stored as square chunks at an aligned offset. The file
+    is memory-mapped; at most max_chunks chunks are kept resident, the least
+    recently used ones are released. The grid may be indexed like a numpy
+    array: grid[y, x], grid[y0:y1, x0:x1] or grid[ys, xs] with index arrays.
+    """
+
+    def __init__(self, path, max_chunks=MAX_TRACK_CHUNKS):
+        """Opens the tiled track file
+        """
+        self._file = open(path, "rb")
+        magic = self._file.read(len(TILED_TRACK_MAGIC))
+        if magic!=TILED_TRACK_MAGIC:
+            self._file.close()
+            raise ValueError("'%s' is not a tiled track file." % path)
+        length = struct.unpack("<I", self._file.read(4))[0]
+        header = json.loads(self._file.read(length).decode("utf-8"))
+        self._width = header["width"]
+        self._height = header["height"]
+        self._chunk = header["chunk"]
+        self._palette = [tuple(c) for c in header["palette"]]
+        self._start_positions = [tuple(p) for p in header["start_positions"]]
+        self._ncx = (self._width + self._chunk - 1) // self._chunk
+        self._ncy = (self._height + self._chunk - 1) // self._chunk
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = np.frombuffer(self._mmap, dtype=np.uint8,
+            count=self._ncx*self._ncy*self._chunk*self._chunk,
+            offset=TILED_TRACK_ALIGN).reshape(self._ncy, self._ncx, self._chunk, self._chunk)
+        self._max_chunks = max(1, max_chunks)
+        self._chunks = OrderedDict()
+        self.shape = (self._height, self._width)
+
+
+    def close(self):
+        """Closes the file"""
+        self._chunks.clear()
+        self._data = None
+        self._mmap.close()
+        self._file.close()
+
+
+    def get_chunk(self, cy, cx):
+        """Returns the chunk with the given index, making it resident"""
+        key = (cy, cx)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+        chunk = self._chunks[key] = self._data[cy, cx]
+        while len(self._chunks)>self._max_chunks:
+            (ey, ex), _ = self._chunks.popitem(last=False)
+            if hasattr(mmap, "MADV_DONTNEED"):
+                # let the system drop the released chunk's pages
+                size = self._chunk * self._chunk
+                self._mmap.madvise(mmap.MADV_DONTNEED, TILED_TRACK_ALIGN + (ey*self._ncx+ex)*size, size)
+        return chunk
+
+
+    def __getitem__(self, key):
+        """Returns the floor code(s) at the given index/indices, indexed [y, x]"""
+        y, x = key
+        c = self._chunk
+        if isinstance(y, slice) or isinstance(x, slice):
+            y0, y1, _ = (y if isinstance(y, slice) else slice(y, y+1)).indices(self._height)
+            x0, x1, _ = (x if isinstance(x, slice) else slice(x, x+1)).indices(self._width)
+            area = np.empty((max(0, y1-y0), max(0, x1-x0)), dtype=np.uint8)
+            for cy in range(y0//c, (y1-1)//c+1 if y1>y0 else 0):
+                for cx in range(x0//c, (x1-1)//c+1 if x1>x0 else 0):
+                    ay0 = max(y0, cy*c)
+                    ay1 = min(y1, cy*c+c)
+                    ax0 = max(x0, cx*c)
+                    ax1 = min(x1, cx*c+c)
+                    chunk = self.get_chunk(cy, cx)
+                    area[ay0-y0:ay1-y0, ax0-x0:ax1-x0] = chunk[ay0-cy*c:ay1-cy*c, ax0-cx*c:ax1-cx*c]
+            if not isinstance(y, slice):
+                area = area[0]
+            elif not isinstance(x, slice):
+                area = area[:, 0]
+            return area
+        if np.ndim(y)==0 and np.ndim(x)==0:
+            if y<0 or y>=self._height or x<0 or x>=self._width:
+                raise IndexError("position (%s, %s) is outside the track" % (x, y))
+            return self.get_chunk(y // c, x // c)[y % c, x % c]
+        y = np.asarray(y)
+        x = np.asarray(x)
+        ids = (y // c) * self._ncx + x // c
+        floors = np.empty(y.shape, dtype=np.uint8)
+        for i in np.unique(ids):
+            m = ids==i
+            floors[m] = self.get_chunk(int(i) // self._ncx, int(i) % self._ncx)[y[m] % c, x[m] % c]
+        return floors
+
 
 
 
@@ -155,20 +1142,66 @@ class Track:
     A class that stores the track.
     """
     
-    def __init__(self, image):
+    def __init__(self, image, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS, grid=None, palette=None,
+            start_positions=None, progress=None, distances=None, racing_line=None):
         """Initialises the track
+
+        The track is decoded from the given image. Alternatively, image may be
+        None and the track is given as a grid of floor codes (see decode_track),
+        either an array or a ChunkedGrid. The palette defaults to the
+        FLOOR_COLORS then. The start positions are searched in the grid unless
+        given.
+
+        The progress field (see compute_progress), the distance fields (see
+        compute_distances) and the racing line (see compute_racing_line, given
+        as the tuple it returns) are computed unless given. They are not
+        computed for a ChunkedGrid, as they would have to be kept in memory
+        completely; the races on such tracks are not validated, the vehicles'
+        movements are not traced and there are no opponents.
+
+        If chunk_size is larger than zero, the track is drawn using pre-rendered
+        chunks of this size (see TrackRenderCache). Otherwise, each tile is drawn
+        as a filled polygon.
         """
-        self._height = image.get_height()
-        self._width = image.get_width()
-        self._start_positions = []
-        self._image = image
-        for y in range(0, self._height):
-            for x in range(0, self._width):
-                col = self._image.get_at((x, y))
-                #print (col)
-                if col==TILE_START:
-                    self._start_positions.append((x, y))
-                    self._image.set_at((x, y), TILE_TRACK)
+        if image is not None:
+            grid, palette = decode_track(image)
+        elif not isinstance(grid, ChunkedGrid):
+            grid = np.array(grid, dtype=np.uint8)
+        self._grid = grid
+        self._palette = list(palette) if palette is not None else list(FLOOR_COLORS)
+        self._height, self._width = self._grid.shape
+        if start_positions is None:
+            ys, xs = np.nonzero(self._grid==FLOOR_START)
+            start_positions = [(int(x), int(y)) for x, y in zip(xs, ys)]
+            self._grid[ys, xs] = FLOOR_TRACK
+        self._start_positions = list(start_positions)
+        if progress is None and not isinstance(self._grid, ChunkedGrid):
+            progress = compute_progress(self._grid, self._start_positions)
+        self._progress = progress
+        self._length = int(progress.max()) if progress is not None else 0
+        self._circuit = progress is not None and is_circuit(self._grid, progress)
+        if distances is None and not isinstance(self._grid, ChunkedGrid):
+            distances = compute_distances(self._grid)
+        self._distances = distances
+        if racing_line is None and progress is not None:
+            racing_line = compute_racing_line(self._grid, progress)
+        if racing_line is None:
+            racing_line = (None, None, None)
+        self._remaining, self._racing_line, self._speeds = racing_line
+        self._render_cache = None
+        if chunk_size>0:
+            self._render_cache = TrackRenderCache(self._grid, self._palette, chunk_size, max_chunks)
+
+    
+    def set_tile_size(self, tile_size):
+        """Draws the tiles tile_size pixels large (see get_render_size)
+
+        Tracks drawn at other sizes than SIZE are always drawn using chunks.
+        """
+        cache = self._render_cache
+        chunk_size = cache._chunk_tiles * SIZE if cache is not None else CHUNK_SIZE
+        max_chunks = cache._max_chunks if cache is not None else MAX_CHUNKS
+        self._render_cache = TrackRenderCache(self._grid, self._palette, chunk_size, max_chunks, tile_size)
 
     
     def get_next_starting_position(self):
@@ -179,13 +1212,135 @@ class Track:
         
         
     def get_floor(self, x, y):
-        """Returns the type of the floow that is below the given position.
+        """Returns the type (FLOOR_*) of the floor that is below the given position.
+        """
+        return self._grid[int(y/SIZE), int(x/SIZE)]
+
+
+    def get_progress(self, x, y):
+        """Returns the distance along the track (see compute_progress) at the given position
+
+        Returns -1 off the track or if the track has no progress field.
+        """
+        if self._progress is None:
+            return -1
+        return int(self._progress[int(y/SIZE), int(x/SIZE)])
+
+
+    def trace(self, x0, y0, x1, y1, floor):
+        """Follows the straight movement from (x0, y0) to (x1, y1)
+
+        Returns the fraction of the movement after which it enters a tile of
+        grass, tires or the goal, and the type of the entered tile. Tiles of
+        the given floor type (the one the movement starts on) are ignored.
+        Returns 1 and None if no such tile is entered or the track has no
+        distance fields.
+
+        Far from such tiles, the movement advances by the distance fields'
+        values (sphere tracing), close to them from tile border to tile border.
+        So the number of lookups does not grow with the movement's length
+        unless the movement passes such tiles closely.
         """
-        return self._image.get_at((int(x/SIZE), int(y/SIZE)))
+        if self._distances is None:
+            return 1., None
+        dx = x1 - x0
+        dy = y1 - y0
+        length = max(abs(dx), abs(dy))
+        if length==0:
+            return 1., None
+        # the fields of the floor types but the given one
+        fields = [field for field, f in zip(self._distances, DISTANCE_FLOORS) if f!=floor]
+        t = 0.
+        cx = int(x0/SIZE)
+        cy = int(y0/SIZE)
+        while True:
+            ix = min(max(cx, 0), self._width-1)
+            iy = min(max(cy, 0), self._height-1)
+            d = min([int(field[iy, ix]) for field in fields])
+            if d==0:
+                return t, int(self._grid[iy, ix])
+            if d>1:
+                # no such tile is closer than d-1 tiles
+                t += (d-1) * SIZE / length
+                if t>=1:
+                    return 1., None
+                cx = int((x0+dx*t)/SIZE)
+                cy = int((y0+dy*t)/SIZE)
+                continue
+            tx = ((cx+1)*SIZE - x0) / dx if dx>0 else (cx*SIZE - x0) / dx if dx<0 else 2.
+            ty = ((cy+1)*SIZE - y0) / dy if dy>0 else (cy*SIZE - y0) / dy if dy<0 else 2.
+            t = min(tx, ty)
+            if t>1:
+                return 1., None
+            if tx<=ty:
+                cx += 1 if dx>0 else -1
+            else:
+                cy += 1 if dy>0 else -1
+
+
+    def trace_many(self, x0, y0, x1, y1, floors):
+        """Follows the straight movements given as arrays, see trace
+
+        Returns the arrays of the fractions and of the types of the entered
+        tiles (255 if none is entered).
+        """
+        n = len(x0)
+        result = np.ones(n, dtype=np.float64)
+        hit = np.full(n, 255, dtype=np.uint8)
+        if self._distances is None:
+            return result, hit
+        dx = x1 - x0
+        dy = y1 - y0
+        length = np.maximum(np.abs(dx), np.abs(dy))
+        t = np.zeros(n, dtype=np.float64)
+        cx = np.trunc(x0/SIZE).astype(np.intp)
+        cy = np.trunc(y0/SIZE).astype(np.intp)
+        active = np.nonzero(length>0)[0]
+        while len(active):
+            i = active
+            ix = np.clip(cx[i], 0, self._width-1)
+            iy = np.clip(cy[i], 0, self._height-1)
+            d = np.full(len(i), 255, dtype=np.int64)
+            for field, floor in zip(self._distances, DISTANCE_FLOORS):
+                d = np.minimum(d, np.where(floors[i]==floor, 255, field[iy, ix]))
+            entered = d==0
+            result[i[entered]] = t[i[entered]]
+            hit[i[entered]] = self._grid[iy[entered], ix[entered]]
+            far = i[d>1]
+            t[far] += (d[d>1]-1) * SIZE / length[far]
+            far = far[t[far]<1]
+            cx[far] = np.trunc((x0[far]+dx[far]*t[far])/SIZE).astype(np.intp)
+            cy[far] = np.trunc((y0[far]+dy[far]*t[far])/SIZE).astype(np.intp)
+            near = i[d==1]
+            ndx = dx[near]
+            ndy = dy[near]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                tx = np.where(ndx>0, ((cx[near]+1)*SIZE - x0[near]) / ndx,
+                    np.where(ndx<0, (cx[near]*SIZE - x0[near]) / ndx, 2.))
+                ty = np.where(ndy>0, ((cy[near]+1)*SIZE - y0[near]) / ndy,
+                    np.where(ndy<0, (cy[near]*SIZE - y0[near]) / ndy, 2.))
+            tn = np.minimum(tx, ty)
+            inside = tn<=1
+            near = near[inside]
+            t[near] = tn[inside]
+            step_x = (tx<=ty)[inside]
+            cx[near[step_x]] += np.where(ndx[inside][step_x]>0, 1, -1)
+            cy[near[~step_x]] += np.where(ndy[inside][~step_x]>0, 1, -1)
+            active = np.concatenate((far, near))
+        return result, hit
     
     
     def draw(self, surface, view):
         """Draws the track
+        """
+        if self._render_cache is not None:
+            self._render_cache.draw(surface, view)
+        else:
+            self.draw_tiles(surface, view)
+
+
+    def draw_tiles(self, surface, view):
+        """Draws the track tile by tile
         
         Well, ok. Computing the offset / initial (top left-most one) tile took me
         to long. I suppose there is a better way to do this.
@@ -218,7 +1373,66 @@ class Track:
                 p.append([xp+SIZE, yp+SIZE])
                 p.append([xp, yp+SIZE])
                 p.append([xp, yp])
-                pygame.gfxdraw.filled_polygon(surface, p, self._image.get_at((x, y)))
+                pygame.gfxdraw.filled_polygon(surface, p, self._palette[self._grid[y, x]])
+
+
+
+
+class SpriteCache:
+    """
+    Rotated versions of an image, keyed by the quantised angle.
+
+    The angles are quantised into steps of the given resolution (in degrees).
+    Each rotation is computed once, either when first needed or for all angles
+    at once using build. If smooth is set, the rotations are anti-aliased using
+    rotozoom. A cache may be shared by all vehicles that use the same image.
+    """
+
+    def __init__(self, image, resolution=SPRITE_RESOLUTION, smooth=False):
+        """Initialises the cache
+        """
+        if resolution<=0:
+            raise ValueError("The sprite resolution must be positive.")
+        self._image = image
+        self._center = image.get_rect().center
+        self._resolution = resolution
+        self._steps = max(1, int(round(360. / resolution)))
+        self._smooth = smooth
+        self._sprites = [None] * self._steps
+
+
+    def build(self):
+        """Computes the rotations for all angles
+        """
+        for i in range(self._steps):
+            if self._sprites[i] is None:
+                self._sprites[i] = self._rotate(i)
+
+
+    def get(self, angle):
+        """Returns the rotated image and its offset to the image's center
+
+        The offset is the one of the rotated image's top left corner to the
+        center of the unrotated image.
+        """
+        i = int(round(angle / self._resolution)) % self._steps
+        sprite = self._sprites[i]
+        if sprite is None:
+            sprite = self._sprites[i] = self._rotate(i)
+        return sprite
+
+
+    def _rotate(self, i):
+        """Computes the rotation with the given index
+        """
+        angle = i * 360. / self._steps
+        if self._smooth:
+            image = pygame.transform.rotozoom(self._image, angle, 1)
+        else:
+            image = pygame.transform.rotate(self._image, angle)
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha()
+        return image, image.get_rect(center=self._center).topleft
 
 
 
@@ -230,23 +1444,51 @@ class Vehicle:
     It has a velocity and a delta-orientation as well...
     """
     
-    def __init__(self, x, y, o, image):
-        """Initialises the vehicle"""
+    def __init__(self, x, y, o, image, sprites=None):
+        """Initialises the vehicle
+
+        The rotated images are taken from the given SpriteCache; the vehicle
+        builds an own one for the image if none is given. Vehicles that are
+        only simulated need no image.
+        """
         self._x = x
         self._y = y
         self._o = o
         self._v = 0
         self._do = 0
         self._image = image
+        if sprites is None and image is not None:
+            sprites = SpriteCache(image)
+        self._sprites = sprites
         self._offtrack = 0
+        self._stop_at_goal = True
+        self._prev_state = (x, y, o)
         
 
-    def draw(self, surface):
-        """Draws the vehicle onto the given surface"""
-        rot_image = pygame.transform.rotate(self._image, self._o)
-        rot_rect = rot_image.get_rect(center=(8, 16))  
-        rot_rect = rot_rect.move((SCR_WIDTH/2, SCR_HEIGHT/2))
-        surface.blit(rot_image, rot_rect)
+    def get_interpolated(self, alpha):
+        """Returns the position and orientation between the previous and the current step
+
+        alpha=0 yields the state before the last step, alpha=1 the current one.
+        """
+        px, py, po = self._prev_state
+        do = (self._o - po + 180) % 360 - 180
+        return px + (self._x - px) * alpha, py + (self._y - py) * alpha, po + do * alpha
+
+
+    def draw(self, surface, alpha=1., view=None, scale=1.):
+        """Draws the vehicle onto the given surface
+
+        The vehicle is drawn at the surface's center unless the shown part of
+        the track (view) is given; view is given in pixels of the track drawn
+        at the given scale. Returns the rectangle that was drawn.
+        """
+        x, y, o = (self._x, self._y, self._o) if alpha>=1 else self.get_interpolated(alpha)
+        rot_image, offset = self._sprites.get(o)
+        if view is None:
+            return surface.blit(rot_image,
+                (surface.get_width()//2 + offset[0], surface.get_height()//2 + offset[1]))
+        return surface.blit(rot_image,
+            (int(x*scale) - view.left + offset[0], int(y*scale) - view.top + offset[1]))
 
 
     def accel(self, dt, value):
@@ -259,21 +1501,45 @@ class Vehicle:
         self._do += self._v * value
 
 
-    def step(self, game, dt):
-        """Performs a simulation step"""
-        floor = game._track.get_floor(self._x, self._y)
-        if floor==TILE_GOAL:
-            game.track_finished()
+    def control(self, dt, inputs):
+        """Applies the given inputs (a combination of the INPUT_* bits)"""
+        left = inputs & INPUT_LEFT
+        right = inputs & INPUT_RIGHT
+        up = inputs & INPUT_UP
+        down = inputs & INPUT_DOWN
+        if left and not right:
+            self.steer(dt, 5)
+        if right and not left:
+            self.steer(dt, -5)
+        if up and not down:
+            self.accel(dt, 1)
+        if down and not up:
+            self.accel(dt, -1)
+
+
+    def step(self, track, dt):
+        """Performs a simulation step
+
+        Returns the type of the floor the step started on; reaching FLOOR_GOAL
+        stops the vehicle unless _stop_at_goal is unset (see Simulation).
+
+        The movement is traced (see Track.trace), so that it ends on the first
+        tile of another floor type it enters (grass, tires or the goal)
+        instead of passing it at high speeds.
+        """
+        self._prev_state = (self._x, self._y, self._o)
+        floor = track.get_floor(self._x, self._y)
+        if floor==FLOOR_GOAL and self._stop_at_goal:
             self._v = 0
             self._do = 0
-        elif floor==TILE_GRASS:
+        elif floor==FLOOR_GRASS:
             v = self._v
             if self._v>1:
                 self.accel(dt, -10)
             else:
                 self._v = max(-0.1, min(0.1, self._v))
             self._offtrack += dt
-        elif floor==TILE_TIRES:
+        elif floor==FLOOR_TIRES:
             self._v = 0
         self._o += self._do * dt
         while self._o>360:
@@ -282,9 +1548,17 @@ class Vehicle:
             self._o += 360
         ndo = max(0, abs(self._do)*.9)
         self._do = ndo if self._do>=0 else -ndo
-        self._x += math.sin(self._o / 180 * math.pi) * self._v
-        self._y += math.cos(self._o / 180 * math.pi) * self._v
-        game._engine_sound.set_volume(max(.2, .2+.8*min(150, self._v*20)/150.))
+        x = self._x + math.sin(self._o / 180 * math.pi) * self._v
+        y = self._y + math.cos(self._o / 180 * math.pi) * self._v
+        t, entered = track.trace(self._x, self._y, x, y, floor)
+        if entered is not None:
+            # moves a bit beyond the entered tile's border to be on it
+            t = min(1., t + TRACE_OVERSHOOT / max(abs(x-self._x), abs(y-self._y)))
+            x = self._x + (x - self._x) * t
+            y = self._y + (y - self._y) * t
+        self._x = x
+        self._y = y
+        return floor
 
 
 
@@ -292,202 +1566,1590 @@ class Vehicle:
 class Ego(Vehicle):
     """The ego vehicle, just a derivation of Vehicle with no additional functionality"""
     
-    def __init__(self, x, y, o, image):
+    def __init__(self, x, y, o, image, sprites=None):
         """Initialises the vehicle"""
-        Vehicle.__init__(self, x, y, o, image)
+        Vehicle.__init__(self, x, y, o, image, sprites)
 
 
 
 
-class NPC(Vehicle):
-    """An NPC vehicle, currently not used, just a derivation of Vehicle with no additional functionality"""
-    def __init__(self, x, y, o, image):
-        """Initialises the vehicle"""
-        Vehicle.__init__(self, x, y, o, image)
+class VehicleBatch:
+    """Many vehicles, simulated at once
+
+    The states of the vehicles (position, orientation, velocity,
+    delta-orientation and the time spent off the track) are stored in arrays.
+    A step applies the rules of Vehicle.control and Vehicle.step to all
+    vehicles at once. Positions outside the track are treated as being on the
+    nearest border tile.
+    """
+
+    def __init__(self, n, x=0, y=0, o=0):
+        """Initialises the batch, all vehicles at the given position"""
+        self._x = np.full(n, x, dtype=np.float64)
+        self._y = np.full(n, y, dtype=np.float64)
+        self._o = np.full(n, o, dtype=np.float64)
+        self._v = np.zeros(n, dtype=np.float64)
+        self._do = np.zeros(n, dtype=np.float64)
+        self._offtrack = np.zeros(n, dtype=np.float64)
+        self._stop_at_goal = np.ones(n, dtype=bool)
+        self._finished = np.zeros(n, dtype=bool)
+
+
+    def __len__(self):
+        """Returns the number of vehicles"""
+        return len(self._x)
+
+
+    def control(self, dt, inputs):
+        """Applies the inputs (an array of INPUT_* bit combinations, one per vehicle)"""
+        inputs = np.asarray(inputs)
+        left = (inputs & INPUT_LEFT)!=0
+        right = (inputs & INPUT_RIGHT)!=0
+        up = (inputs & INPUT_UP)!=0
+        down = (inputs & INPUT_DOWN)!=0
+        steer = np.where(left & ~right, 5, 0) + np.where(right & ~left, -5, 0)
+        self._do += self._v * steer
+        accel = np.where(up & ~down, 1, 0) + np.where(down & ~up, -1, 0)
+        m = accel!=0
+        self._v[m] = np.minimum(100, np.maximum(-10, self._v[m] + accel[m] * dt))
+
+
+    def get_floors(self, track):
+        """Returns the types of the floors below the vehicles"""
+        grid = track._grid
+        xi = np.clip(np.trunc(self._x / SIZE).astype(np.intp), 0, grid.shape[1]-1)
+        yi = np.clip(np.trunc(self._y / SIZE).astype(np.intp), 0, grid.shape[0]-1)
+        return grid[yi, xi]
+
+
+    def step(self, track, dt, inputs=None):
+        """Performs a simulation step
+
+        The inputs are applied first if given. Returns the floor types the
+        vehicles started the step on, like Vehicle.step.
+        """
+        if inputs is not None:
+            self.control(dt, inputs)
+        floors = self.get_floors(track)
+        goal = (floors==FLOOR_GOAL) & self._stop_at_goal
+        self._v[goal] = 0
+        self._do[goal] = 0
+        self._finished |= goal
+        grass = floors==FLOOR_GRASS
+        fast = grass & (self._v>1)
+        self._v[fast] = np.minimum(100, np.maximum(-10, self._v[fast] - 10 * dt))
+        slow = grass & ~fast
+        self._v[slow] = np.clip(self._v[slow], -0.1, 0.1)
+        self._offtrack[grass] += dt
+        self._v[floors==FLOOR_TIRES] = 0
+        self._o += self._do * dt
+        m = self._o>360
+        while m.any():
+            self._o[m] -= 360
+            m = self._o>360
+        m = self._o<-360
+        while m.any():
+            self._o[m] += 360
+            m = self._o<-360
+        self._do *= .9
+        a = self._o / 180 * math.pi
+        x = self._x + np.sin(a) * self._v
+        y = self._y + np.cos(a) * self._v
+        t, entered = track.trace_many(self._x, self._y, x, y, floors)
+        m = entered!=255
+        if m.any():
+            length = np.maximum(np.abs(x[m]-self._x[m]), np.abs(y[m]-self._y[m]))
+            t[m] = np.minimum(1., t[m] + TRACE_OVERSHOOT / length)
+            x[m] = self._x[m] + (x[m] - self._x[m]) * t[m]
+            y[m] = self._y[m] + (y[m] - self._y[m]) * t[m]
+        self._x = x
+        self._y = y
+        return floors
+
+
+
+
+class Opponents:
+    """AI opponents
+
+    The opponents follow the track's racing line (see compute_racing_line).
+    Each steers towards the line's point RACING_LINE_LOOKAHEAD tiles closer
+    to the goal than the tile it is on and accelerates or brakes towards the
+    line's target speed there, scaled by its skill. So a step costs a few
+    table lookups per opponent; the opponents are simulated as a
+    VehicleBatch. They start in rows of three in front of the start
+    position. As tires stop a vehicle completely, opponents that stood on
+    tires for NPC_RECOVERY_STEPS steps are put back onto the racing line.
+    """
+
+    def __init__(self, track, n, skill=NPC_SKILL):
+        """Initialises the opponents
+
+        The skills are spread evenly over the given range.
+        """
+        if track._racing_line is None:
+            raise ValueError("The track has no racing line.")
+        self._track = track
+        line = track._racing_line
+        sx, sy = track.get_next_starting_position()
+        first = track._remaining[int(sy/SIZE), int(sx/SIZE)]
+        first = first if first>0 else len(line)-1
+        positions = []
+        row = 1
+        while len(positions)<n and first-row*NPC_ROW_TILES>=1:
+            i = first - row*NPC_ROW_TILES
+            dx, dy = line[i-1] - line[min(i+1, len(line)-1)]
+            norm = math.hypot(dx, dy) or 1.
+            o = math.degrees(math.atan2(dx, dy))
+            for column in (-1, 0, 1):
+                x = line[i][0] - dy / norm * column * NPC_COLUMN_GAP
+                y = line[i][1] + dx / norm * column * NPC_COLUMN_GAP
+                if len(positions)<n and track.get_floor(x, y) not in DISTANCE_FLOORS:
+                    positions.append((x, y, o))
+            row += 1
+        while len(positions)<n:
+            positions.append((sx, sy, 180))
+        self._batch = VehicleBatch(n)
+        self._starts = np.array(positions, dtype=np.float64).reshape(n, 3).T
+        self._batch._x[:], self._batch._y[:], self._batch._o[:] = self._starts
+        self._skill = np.linspace(skill[0], skill[1], n) if n>1 else np.full(n, skill[1])
+        self._first = first
+        self._index = np.full(n, first, dtype=np.intp)
+        self._stuck = np.zeros(n, dtype=np.int64)
+        self._prev_state = (self._batch._x.copy(), self._batch._y.copy(), self._batch._o.copy())
+
+
+    def __len__(self):
+        """Returns the number of opponents"""
+        return len(self._batch)
+
+
+    def get_inputs(self):
+        """Returns the opponents' inputs (INPUT_* bit combinations)"""
+        batch = self._batch
+        xi = np.clip(np.trunc(batch._x / SIZE).astype(np.intp), 0, self._track._width-1)
+        yi = np.clip(np.trunc(batch._y / SIZE).astype(np.intp), 0, self._track._height-1)
+        remaining = self._track._remaining[yi, xi]
+        # the goal's tiles begin a new lap
+        remaining = np.where(self._track._grid[yi, xi]==FLOOR_GOAL, len(self._track._racing_line)-1,
+            remaining)
+        self._index = np.where(remaining>=0, remaining, self._index)
+        target = self._track._racing_line[np.maximum(self._index - RACING_LINE_LOOKAHEAD, 0)]
+        heading = np.degrees(np.arctan2(target[:, 0] - batch._x, target[:, 1] - batch._y))
+        turn = (heading - batch._o + 180) % 360 - 180
+        speed = self._track._speeds[self._index] * self._skill
+        return np.where(turn>NPC_STEER_TOLERANCE, INPUT_LEFT, 0) \
+            | np.where(turn<-NPC_STEER_TOLERANCE, INPUT_RIGHT, 0) \
+            | np.where(batch._v<speed, INPUT_UP, 0) | np.where(batch._v>speed+.5, INPUT_DOWN, 0)
+
+
+    def step(self, dt):
+        """Performs a simulation step, returns the floors the opponents started on"""
+        batch = self._batch
+        self._prev_state = (batch._x.copy(), batch._y.copy(), batch._o.copy())
+        floors = batch.step(self._track, dt, self.get_inputs())
+        tires = floors==FLOOR_TIRES
+        self._stuck = np.where(tires, self._stuck + 1, 0)
+        stuck = self._stuck>=NPC_RECOVERY_STEPS
+        if stuck.any():
+            self.recover(stuck)
+        return floors
+
+
+    def recover(self, mask):
+        """Puts the selected opponents back onto the racing line, standing, heading along it"""
+        batch = self._batch
+        line = self._track._racing_line
+        index = self._index[mask]
+        x, y = line[index].T
+        target = line[np.maximum(index - RACING_LINE_LOOKAHEAD, 0)]
+        batch._x[mask] = x
+        batch._y[mask] = y
+        batch._o[mask] = np.degrees(np.arctan2(target[:, 0] - x, target[:, 1] - y))
+        batch._v[mask] = 0
+        batch._do[mask] = 0
+        self._stuck[mask] = 0
+        for state, values in zip(self._prev_state, (batch._x, batch._y, batch._o)):
+            state[mask] = values[mask]
+
+
+    def return_to_start(self, mask):
+        """Moves the selected opponents back to their start positions, keeping their speed"""
+        batch = self._batch
+        batch._x[mask], batch._y[mask], batch._o[mask] = self._starts[:, mask]
+        batch._do[mask] = 0
+        self._index[mask] = self._first
+        for state, values in zip(self._prev_state, (batch._x, batch._y, batch._o)):
+            state[mask] = values[mask]
+
+
+    def get_interpolated(self, alpha):
+        """Returns the positions and orientations between the previous and the current step"""
+        px, py, po = self._prev_state
+        batch = self._batch
+        do = (batch._o - po + 180) % 360 - 180
+        return px + (batch._x - px) * alpha, py + (batch._y - py) * alpha, po + do * alpha
+
+
+    def draw(self, surface, view, sprites, alpha=1., scale=1.):
+        """Draws the opponents that are within the view
+
+        The view is given in pixels of the track drawn at the given scale.
+        Returns the rectangles that were drawn.
+        """
+        x, y, o = self.get_interpolated(alpha)
+        x = x * scale
+        y = y * scale
+        margin = 2 * SIZE * scale
+        visible = np.nonzero((x>view.left-margin) & (x<view.right+margin)
+            & (y>view.top-margin) & (y<view.bottom+margin))[0]
+        rects = []
+        for i in visible:
+            rot_image, offset = sprites.get(o[i])
+            rects.append(surface.blit(rot_image,
+                (int(x[i]) - view.left + offset[0], int(y[i]) - view.top + offset[1])))
+        return rects
+
+
+
+
+class Simulation:
+    """A race without graphics or sound
+
+    The simulation consists of a track and vehicles that are driven by inputs
+    (combinations of the INPUT_* bits). It does not need a display or a mixer,
+    so it may be used to replay or evaluate laps faster than real time. With a
+    fixed step duration, the same inputs always yield the same race.
+
+    The vehicles' progress is read from the track's progress field. A lap
+    counts only if the vehicle passed the track's checkpoints (tiles at equal
+    distances along the track) in order, each while driving on the track, not
+    by leaving it and returning further ahead. The vehicles stop at the goal
+    when finishing their last lap and drive over it before. On tracks without
+    a progress field, reaching the goal finishes the race.
+
+    AI opponents (see Opponents) may be added; they are ranked like the
+    vehicles (their indices follow the vehicles' ones), but as they do not
+    cut, their laps are counted without checking the checkpoints.
+    """
+
+    def __init__(self, track, dt=1./PHYSICS_HZ, laps=1, checkpoints=CHECKPOINTS):
+        """Initialises the simulation
+        """
+        self._track = track
+        self._dt = dt
+        self._laps = laps
+        self._checkpoints = [track._length * (i+1) // (checkpoints+1) for i in range(checkpoints)]
+        self._vehicles = []
+        self._finish_times = []
+        self._progress = []
+        self._best_progress = []
+        self._passed = []
+        self._lap = []
+        self._wrong_way = []
+        self._starts = []
+        self._opponents = None
+        self._steps = 0
+        self._time = 0
+
+
+    def add_vehicle(self, vehicle):
+        """Adds a vehicle and returns it"""
+        self._vehicles.append(vehicle)
+        self._finish_times.append(None)
+        self._progress.append(max(0, self._track.get_progress(vehicle._x, vehicle._y)))
+        self._best_progress.append(self._progress[-1])
+        self._passed.append(0)
+        self._lap.append(0)
+        self._wrong_way.append(False)
+        self._starts.append((vehicle._x, vehicle._y, vehicle._o))
+        return vehicle
+
+
+    def reset_vehicle(self, index, x, y, o=180):
+        """Moves the vehicle to the given position and restarts its race"""
+        vehicle = self._vehicles[index]
+        vehicle._x, vehicle._y, vehicle._o = x, y, o
+        vehicle._v = 0
+        vehicle._do = 0
+        vehicle._offtrack = 0
+        vehicle._prev_state = (x, y, o)
+        self._finish_times[index] = None
+        self._progress[index] = max(0, self._track.get_progress(x, y))
+        self._best_progress[index] = self._progress[index]
+        self._passed[index] = 0
+        self._lap[index] = 0
+        self._wrong_way[index] = False
+        self._starts[index] = (x, y, o)
+
+
+    def return_to_start(self, index):
+        """Moves the vehicle back to its start position, keeping its speed"""
+        vehicle = self._vehicles[index]
+        x, y, o = self._starts[index]
+        vehicle._x, vehicle._y, vehicle._o = x, y, o
+        vehicle._do = 0
+        vehicle._prev_state = (x, y, o)
+        self._progress[index] = max(0, self._track.get_progress(x, y))
+        self._best_progress[index] = self._progress[index]
+
+
+    def add_opponents(self, n, skill=NPC_SKILL):
+        """Adds n AI opponents and returns them (see Opponents)"""
+        self._opponents = Opponents(self._track, n, skill)
+        self._opponent_progress = np.maximum(self.get_opponent_progress(), 0)
+        self._opponent_lap = np.zeros(n, dtype=np.int64)
+        self._opponent_finish_times = np.full(n, -1, dtype=np.int64)
+        return self._opponents
+
+
+    def get_vehicle_count(self):
+        """Returns the number of vehicles including the opponents"""
+        return len(self._vehicles) + (len(self._opponents) if self._opponents is not None else 0)
+
+
+    def step(self, inputs, dt=None):
+        """Performs a simulation step
+
+        inputs holds the inputs for each vehicle. The step's duration is the
+        simulation's one unless dt is given. Returns the floor types the
+        vehicles started the step on.
+        """
+        dt = self._dt if dt is None else dt
+        self._steps += 1
+        self._time += dt * 1000.
+        validate = self._track._progress is not None
+        floors = []
+        for i, vehicle in enumerate(self._vehicles):
+            vehicle.control(dt, inputs[i])
+            progress = self._track.get_progress(vehicle._x, vehicle._y)
+            if validate:
+                vehicle._stop_at_goal = self._lap[i]+1>=self._laps \
+                    and self._passed[i]==len(self._checkpoints)
+            floor = vehicle.step(self._track, dt)
+            if not validate:
+                if floor==FLOOR_GOAL and self._finish_times[i] is None:
+                    self._finish_times[i] = int(self._time)
+            elif floor==FLOOR_GOAL:
+                self.cross_goal(i)
+            elif progress>=0:
+                self.advance(i, progress)
+            floors.append(floor)
+        if self._opponents is not None:
+            self.step_opponents(dt)
+        return floors
+
+
+    def get_opponent_progress(self):
+        """Returns the progress (see Track.get_progress) at the opponents' positions"""
+        batch = self._opponents._batch
+        xi = np.clip(np.trunc(batch._x / SIZE).astype(np.intp), 0, self._track._width-1)
+        yi = np.clip(np.trunc(batch._y / SIZE).astype(np.intp), 0, self._track._height-1)
+        return self._track._progress[yi, xi]
+
+
+    def step_opponents(self, dt):
+        """Performs a simulation step of the opponents and counts their laps"""
+        batch = self._opponents._batch
+        length = self._track._length
+        progress = self.get_opponent_progress()
+        # only the arrival at the goal for the last lap stops an opponent
+        batch._stop_at_goal = (self._opponent_lap+1>=self._laps) & (self._opponent_progress>length//2)
+        floors = self._opponents.step(dt)
+        on_track = (progress>=0) & (progress<length)
+        self._opponent_progress = np.where(on_track, progress, self._opponent_progress)
+        crossing = (floors==FLOOR_GOAL) & (self._opponent_progress>length//2) \
+            & (self._opponent_finish_times<0)
+        self._opponent_lap[crossing] += 1
+        self._opponent_progress[crossing] = 0
+        finished = crossing & (self._opponent_lap>=self._laps)
+        self._opponent_finish_times[finished] = int(self._time)
+        if not self._track._circuit and (crossing & ~finished).any():
+            self._opponents.return_to_start(crossing & ~finished)
+            self._opponent_progress = np.where(crossing & ~finished,
+                np.maximum(self.get_opponent_progress(), 0), self._opponent_progress)
+
+
+    def cross_goal(self, index):
+        """Counts the lap of the vehicle on the goal if it passed all checkpoints
+
+        If the track is no circuit (see is_circuit), the vehicle starts its
+        next lap at its start position.
+        """
+        if self._passed[index]<len(self._checkpoints) or self._finish_times[index] is not None:
+            return
+        self._lap[index] += 1
+        self._passed[index] = 0
+        self._progress[index] = 0
+        self._best_progress[index] = 0
+        self._wrong_way[index] = False
+        if self._lap[index]>=self._laps:
+            self._finish_times[index] = int(self._time)
+        elif not self._track._circuit:
+            self.return_to_start(index)
+
+
+    def advance(self, index, progress):
+        """Moves the vehicle to the given progress, passing the checkpoints in between
+
+        Checkpoints are only passed if the progress grew by at most
+        MAX_PROGRESS_JUMP tiles since the vehicle's last position on the track.
+        """
+        last = self._progress[index]
+        if last<progress<=last+MAX_PROGRESS_JUMP:
+            passed = self._passed[index]
+            while passed<len(self._checkpoints) and last<self._checkpoints[passed]<=progress:
+                passed += 1
+            self._passed[index] = passed
+        self._progress[index] = progress
+        self._best_progress[index] = max(self._best_progress[index], progress)
+        self._wrong_way[index] = progress<self._best_progress[index]-WRONG_WAY_TILES
+
+
+    def get_finish_time(self, index=0):
+        """Returns the time in ms the vehicle needed to finish the race, None if it did not"""
+        if index>=len(self._vehicles):
+            t = self._opponent_finish_times[index-len(self._vehicles)]
+            return int(t) if t>=0 else None
+        return self._finish_times[index]
+
+
+    def get_lap(self, index=0):
+        """Returns the vehicle's current lap (1 is the first)"""
+        return min(self._laps, self._lap[index] + 1)
+
+
+    def is_wrong_way(self, index=0):
+        """Returns whether the vehicle drives backwards"""
+        return self._wrong_way[index]
+
+
+    def get_distance(self, index=0):
+        """Returns the validated distance the vehicle drove in tiles
+
+        The progress within the current lap counts up to the next checkpoint
+        that was not passed.
+        """
+        if index>=len(self._vehicles):
+            index -= len(self._vehicles)
+            return int(self._opponent_lap[index]) * self._track._length \
+                + int(self._opponent_progress[index])
+        progress = self._progress[index]
+        if self._passed[index]<len(self._checkpoints):
+            progress = min(progress, self._checkpoints[self._passed[index]])
+        return self._lap[index] * self._track._length + progress
+
+
+    def get_positions(self):
+        """Returns the indices of the vehicles ordered by their race position
+
+        Finished vehicles come first, ordered by their finish times, the
+        others are ordered by their validated distances.
+        """
+        def key(i):
+            t = self.get_finish_time(i)
+            if t is not None:
+                return (0, t)
+            return (1, -self.get_distance(i))
+        return sorted(range(self.get_vehicle_count()), key=key)
+
+
+    def get_position(self, index=0):
+        """Returns the vehicle's race position (1 is the first)"""
+        return self.get_positions().index(index) + 1
+
+
+    def run(self, inputs, max_steps=None):
+        """Drives the first vehicle using the given sequence of inputs
+
+        Stops when the vehicle finishes, the inputs are exhausted or
+        max_steps were done. Returns the finish time (see get_finish_time).
+        """
+        others = [0] * (len(self._vehicles) - 1)
+        for i, value in enumerate(inputs):
+            if max_steps is not None and i>=max_steps:
+                break
+            self.step([value] + others)
+            if self._finish_times[0] is not None:
+                break
+        return self._finish_times[0]
+
+
+
+
+class Replay:
+    """A recorded race, the ego vehicle's inputs of each simulation step
+
+    The inputs are stored run-length encoded, as players keep keys pressed
+    for many steps: each run of equal inputs is a varint (7 bits per byte,
+    the highest bit marks that more bytes follow) holding the run's length
+    shifted by four bits and the inputs (INPUT_* bits) in the lowest four
+    bits, mostly one or two bytes per run; a lap of track01 needs a few
+    kilobytes. The header holds the simulation rate and the number of laps
+    needed to re-simulate the race as well as the track, the player and the
+    finish time for checking a score's entry.
+    """
+
+    def __init__(self, track=DEFAULT_TRACK, physics_hz=PHYSICS_HZ, laps=1):
+        """Initialises an empty replay"""
+        self._track = track
+        self._physics_hz = physics_hz
+        self._laps = laps
+        self._name = ""
+        self._finish_time = None
+        self._steps = 0
+        self._runs = []
+
+
+    def __len__(self):
+        """Returns the number of recorded steps"""
+        return self._steps
+
+
+    def record(self, inputs):
+        """Appends the inputs of a step"""
+        if self._runs and self._runs[-1][0]==inputs:
+            self._runs[-1][1] += 1
+        else:
+            self._runs.append([inputs, 1])
+        self._steps += 1
+
+
+    def get_inputs(self):
+        """Yields the recorded inputs step by step"""
+        for inputs, count in self._runs:
+            for _ in range(count):
+                yield inputs
+
+
+    def encode(self):
+        """Returns the replay as bytes"""
+        finish_time = -1 if self._finish_time is None else self._finish_time
+        data = bytearray(struct.pack(REPLAY_HEADER, REPLAY_MAGIC, self._physics_hz, self._laps,
+            self._steps, finish_time, len(self._runs)))
+        for text in (self._track, self._name):
+            # shortened to 255 bytes without splitting a character
+            text = text.encode("utf-8")[:255].decode("utf-8", "ignore").encode("utf-8")
+            data.append(len(text))
+            data += text
+        for inputs, count in self._runs:
+            value = count << 4 | inputs
+            while value>=0x80:
+                data.append(value & 0x7f | 0x80)
+                value >>= 7
+            data.append(value)
+        return bytes(data)
+
+
+    @classmethod
+    def decode(cls, data):
+        """Builds a replay from the given bytes
+
+        Raises a ValueError if the data is no (complete) replay.
+        """
+        size = struct.calcsize(REPLAY_HEADER)
+        if len(data)<size:
+            raise ValueError("The replay is truncated.")
+        magic, physics_hz, laps, steps, finish_time, runs = struct.unpack_from(REPLAY_HEADER, data)
+        if magic!=REPLAY_MAGIC or physics_hz==0:
+            raise ValueError("The data is no replay.")
+        texts = []
+        offset = size
+        try:
+            for _ in range(2):
+                length = data[offset]
+                texts.append(data[offset+1:offset+1+length].decode("utf-8"))
+                offset += 1 + length
+            replay = cls(texts[0], physics_hz, laps)
+            replay._name = texts[1]
+            replay._finish_time = None if finish_time<0 else finish_time
+            for _ in range(runs):
+                value = shift = 0
+                while True:
+                    byte = data[offset]
+                    offset += 1
+                    value |= (byte & 0x7f) << shift
+                    shift += 7
+                    if byte<0x80:
+                        break
+                replay._runs.append([value & 0xf, value >> 4])
+        except (IndexError, UnicodeDecodeError):
+            raise ValueError("The replay is truncated.")
+        replay._steps = sum(count for _, count in replay._runs)
+        if replay._steps!=steps:
+            raise ValueError("The replay is corrupt.")
+        return replay
+
+
+    def save(self, path):
+        """Writes the replay into the given file atomically (see write_file)"""
+        write_file(path, lambda fd: fd.write(self.encode()))
+
+
+    @classmethod
+    def load(cls, path):
+        """Reads a replay from the given file"""
+        with open(path, "rb") as fd:
+            return cls.decode(fd.read())
+
+
+    def verify(self, track):
+        """Re-simulates the race on the given track
+
+        Returns the finish time the recorded inputs yield, None if they do not
+        finish the race. Needs neither a display nor a mixer and runs about a
+        thousand times faster than real time.
+        """
+        simulation = Simulation(track, 1. / self._physics_hz, self._laps)
+        x, y = track.get_next_starting_position()
+        simulation.add_vehicle(Vehicle(x, y, 180, None))
+        return simulation.run(self.get_inputs())
+
+
+
+
+class FrameProfiler:
+    """Measures the durations of the phases of each frame
+
+    The durations of the last size frames are kept in a ring buffer. mark(phase)
+    adds the time passed since the previous mark (or the frame's begin) to the
+    given phase (PHASE_*) of the current frame. The statistics may be shown as
+    an overlay and saved as CSV or JSON.
+    """
+
+    def __init__(self, size=PROFILE_FRAMES):
+        """Initialises the profiler"""
+        self._times = np.zeros((size, len(PHASE_NAMES)), dtype=np.float64)
+        self._current = [0.] * len(PHASE_NAMES)
+        self._frames = 0
+        self._last = time.perf_counter()
+        self._visible = False
+
+
+    def mark(self, phase):
+        """Assigns the time since the last mark to the given phase"""
+        t = time.perf_counter()
+        self._current[phase] += t - self._last
+        self._last = t
+
+
+    def end_frame(self):
+        """Stores the current frame's durations and begins a new frame"""
+        self.mark(PHASE_IDLE)
+        self._times[self._frames % len(self._times)] = self._current
+        self._current = [0.] * len(PHASE_NAMES)
+        self._frames += 1
+
+
+    def toggle(self):
+        """Shows or hides the overlay"""
+        self._visible = not self._visible
+
+
+    def get_times(self):
+        """Returns the stored phase durations in s, the oldest frame first"""
+        n = len(self._times)
+        if self._frames<=n:
+            return self._times[:self._frames]
+        i = self._frames % n
+        return np.concatenate((self._times[i:], self._times[:i]))
+
+
+    def get_summary(self):
+        """Returns the frame rate, the median and 99th percentile frame
+        durations and the mean phase durations, all durations in ms"""
+        times = self.get_times()
+        if len(times)==0:
+            return {"fps": 0, "p50": 0, "p99": 0, "phases": dict((name, 0) for name in PHASE_NAMES)}
+        totals = times.sum(axis=1) * 1000.
+        means = times.mean(axis=0) * 1000.
+        return {
+            "fps": 1000. / totals.mean() if totals.mean()>0 else 0,
+            "p50": float(np.percentile(totals, 50)),
+            "p99": float(np.percentile(totals, 99)),
+            "phases": dict((name, float(means[i])) for i, name in enumerate(PHASE_NAMES))
+        }
+
+
+    def draw(self, surface, font, scale=1.):
+        """Draws the overlay if it is visible
+
+        The layout is scaled by the given render scale. Returns the rectangle
+        that was drawn or None.
+        """
+        if not self._visible:
+            return None
+        summary = self.get_summary()
+        lines = ["%.1f fps  p50 %.2f ms  p99 %.2f ms" % (summary["fps"], summary["p50"], summary["p99"])]
+        lines.extend("%-6s %6.2f ms" % (name, summary["phases"][name]) for name in PHASE_NAMES)
+        width = int(360*scale)
+        line_height = int(22*scale)
+        height = len(lines) * line_height
+        panel = pygame.Rect(10, surface.get_height()-20-height, width, height+10)
+        surface.fill((0, 0, 0), panel)
+        frame_ms = 1000. / FPS
+        for i, line in enumerate(lines):
+            y = panel.top + 5 + i * line_height
+            if i>0:
+                bar = int(min(1., summary["phases"][PHASE_NAMES[i-1]] / frame_ms) * (width-int(160*scale)))
+                surface.fill(PHASE_COLORS[i-1],
+                    (panel.left+int(150*scale), y+int(4*scale), max(1, bar), int(12*scale)))
+            surface.blit(font.render(line, True, (255, 255, 255)), (panel.left+5, y))
+        return panel
+
+
+    def save(self, path):
+        """Saves the phase durations (in ms) of the stored frames
+
+        The format (JSON or CSV) is chosen by the file's extension.
+        """
+        times = self.get_times() * 1000.
+        first = self._frames - len(times)
+        if path.lower().endswith(".json"):
+            with open(path, "w") as fd:
+                json.dump({"phases": PHASE_NAMES, "summary": self.get_summary(),
+                    "frames": [[first+i] + row for i, row in enumerate(times.tolist())]}, fd)
+        else:
+            with open(path, "w", newline="") as fd:
+                writer = csv.writer(fd)
+                writer.writerow(["frame"] + PHASE_NAMES + ["total"])
+                for i, row in enumerate(times.tolist()):
+                    writer.writerow([first+i] + ["%.4f" % v for v in row] + ["%.4f" % sum(row)])
+
+
+
+
+
+class AssetLoader:
+    """Loads assets in background threads
+
+    Each asset is loaded by calling the given function in a thread pool.
+    poll returns the assets that were loaded since the last call; errors
+    raised while loading are raised again there.
+    """
+
+    def __init__(self, threads=LOADER_THREADS):
+        """Initialises the loader"""
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._pending = OrderedDict()
+        self._total = 0
+
+
+    def submit(self, name, function, *args):
+        """Starts loading an asset"""
+        self._pending[name] = self._executor.submit(function, *args)
+        self._total += 1
+
+
+    def poll(self, wait=False):
+        """Returns the (name, asset) pairs of the assets loaded since the last call
+
+        If wait is set, all pending assets are waited for.
+        """
+        loaded = []
+        for name, future in list(self._pending.items()):
+            if wait or future.done():
+                del self._pending[name]
+                loaded.append((name, future.result()))
+        if not self._pending:
+            self._executor.shutdown(wait=False)
+        return loaded
+
+
+    def get_progress(self):
+        """Returns the fraction of the assets that were loaded"""
+        return 1. - len(self._pending) / float(self._total) if self._total else 1.
 
-    def step(self, game, dt):
-        """Performs a simulation step"""
-        Vehicle.step(self, x, y, o, image)
 
 
 
 class Game:
     """The game class"""
     
-    def __init__(self):
+    def __init__(self, options=None):
         """Initialises the game
+
+        The options are the ones returned by parse_options; the defaults are
+        used if none are given.
         """
-        path = os.path.dirname(__file__)
-        if not os.path.exists(os.path.join(path, "gfx", "car.png")):
-            path = "."
-        self._car_image = pygame.image.load(os.path.join(path, "gfx", "car.png"))
-        self._title_image = pygame.image.load(os.path.join(path, "gfx", "title.png"))
-        track_image = pygame.image.load(os.path.join(path, "gfx", "track01.png"))
-        self._theme_sound = pygame.mixer.Sound(os.path.join(path, "muzak", "track.ogg"))
-        self._theme_sound.set_volume(1)
-        self._engine_sound = pygame.mixer.Sound(os.path.join(path, "muzak", "engine.ogg"))
-        self._engine_sound.set_volume(.2)
-        self._font = pygame.font.SysFont(None, 48)
-        self._height = track_image.get_height()
-        self._width = track_image.get_width()
-        self._track = Track(track_image)
+        if options is None:
+            options = parse_options([])
+        path = get_data_path()
+        self._options = options
+        # everything is drawn at the render scale
+        self._tile_size, size = get_render_size(options.render_scale)
+        self._scale = self._tile_size / float(SIZE)
+        self._screen = Rect((0, 0), size)
+        self._font = pygame.font.SysFont(None, max(8, int(48*self._scale)))
+        self._texts = TextCache(self._font)
+        self._glyphs = GlyphCache(self._font)
+        self._dim_image = pygame.Surface(size, pygame.SRCALPHA)
+        self._dim_image.fill((0, 0, 0, 100))
+        self._car_image = None
+        self._car_sprites = None
+        self._npc_sprites = None
+        self._ghost_sprites = None
+        self._title_image = None
+        self._track = None
+        self._minimap = None
+        self._theme_sound = None
+        self._engine_sound = None
+        self._ego = None
+        self._players = []
+        self._player_sprites = []
+        self._state = LOADING
+        # the images and the track are needed for the title screen, the sounds
+        # are played as soon as they are loaded
+        cache_dir = None if options.no_cache else options.cache_dir
+        track_path = options.track if options.track else os.path.join(path, "gfx", "track01.png")
+        self._loader = AssetLoader(options.loader_threads)
+        self._loader.submit("car", pygame.image.load, os.path.join(path, "gfx", "car.png"))
+        self._loader.submit("title", pygame.image.load, os.path.join(path, "gfx", "title.png"))
+        self._loader.submit("track", load_track, track_path, options.chunk_size, options.max_chunks,
+            options.max_track_chunks, cache_dir)
+        self._loader.submit("theme", load_sound, os.path.join(path, "muzak", "track.ogg"), cache_dir)
+        self._loader.submit("engine", load_sound, os.path.join(path, "muzak", "engine.ogg"), cache_dir)
         self._theme_channel = pygame.mixer.Channel(0)
         self._engine_channel = pygame.mixer.Channel(1)
-        self._scores = Scores(path)
+        self._scores = Scores(path, os.path.splitext(os.path.basename(track_path))[0])
         self._start_time = 0
+        self._game_time = 0
         self._last_entered_time = 0
         self._quit = False
         self._pressed_keys = set()
-        self.init()
+        self._step_dt = 1. / options.physics_hz if options.physics_hz>0 else 1. / PHYSICS_HZ
+        self._profiler = FrameProfiler()
+        self._profile_font = pygame.font.SysFont(None, max(8, int(24*self._scale)))
+        self._viewports = get_viewports(min(MAX_PLAYERS, max(1, options.players)), *size)
+        self._last_views = [None] * len(self._viewports)
+        self._last_state = None
+        self._last_rects = [[] for _ in self._viewports]
+        self._last_overlays = []
+        if options.no_background_loading:
+            self.finish_loading()
         
 
+    def poll_assets(self, wait=False):
+        """Takes over the assets loaded in the background
+
+        The game run is initialised as soon as the images and the track are
+        available. If wait is set, all assets are waited for.
+        """
+        for name, asset in self._loader.poll(wait):
+            if name=="car":
+                if self._scale<1:
+                    size = (max(1, int(asset.get_width()*self._scale)),
+                        max(1, int(asset.get_height()*self._scale)))
+                    asset = pygame.transform.smoothscale(asset, size)
+                self._car_image = asset
+                self._car_sprites = SpriteCache(asset, self._options.sprite_resolution,
+                    self._options.smooth_sprites)
+                self._player_sprites = [self._car_sprites]
+                for tint in PLAYER_TINTS[1:len(self._viewports)]:
+                    tinted = asset.copy()
+                    tinted.fill(tint, special_flags=pygame.BLEND_RGBA_MULT)
+                    self._player_sprites.append(SpriteCache(tinted, self._options.sprite_resolution,
+                        self._options.smooth_sprites))
+                tinted = asset.copy()
+                tinted.fill(NPC_TINT, special_flags=pygame.BLEND_RGBA_MULT)
+                self._npc_sprites = SpriteCache(tinted, self._options.sprite_resolution,
+                    self._options.smooth_sprites)
+                ghost = asset.copy()
+                ghost.fill((255, 255, 255, GHOST_ALPHA), special_flags=pygame.BLEND_RGBA_MULT)
+                self._ghost_sprites = SpriteCache(ghost, self._options.sprite_resolution,
+                    self._options.smooth_sprites)
+                if self._options.prebuild_sprites:
+                    for sprites in self._player_sprites + [self._npc_sprites, self._ghost_sprites]:
+                        sprites.build()
+            elif name=="title":
+                if self._scale<1:
+                    asset = pygame.transform.smoothscale(asset, self._screen.size)
+                if pygame.display.get_surface() is not None:
+                    asset = asset.convert_alpha()
+                self._title_image = asset
+            elif name=="track":
+                self._track = asset
+                self._height = self._track._height
+                self._width = self._track._width
+                if self._tile_size!=SIZE:
+                    self._track.set_tile_size(self._tile_size)
+                if not self._options.no_minimap:
+                    self._minimap = render_minimap(self._track._grid, int(MINIMAP_SIZE*self._scale))
+                    if pygame.display.get_surface() is not None:
+                        self._minimap = self._minimap.convert()
+            elif name=="theme":
+                self._theme_sound = asset
+                self._theme_sound.set_volume(1)
+                if self._state in (INTRO_TITLE, INTRO_SCORES):
+                    self._theme_channel.play(self._theme_sound, loops=-1)
+            elif name=="engine":
+                self._engine_sound = asset
+                self._engine_sound.set_volume(.2)
+                if self._state in (BEGIN, GAME):
+                    self._engine_channel.play(self._engine_sound, loops=-1)
+        if self._state==LOADING and self._car_image is not None and self._title_image is not None \
+                and self._track is not None:
+            self.init()
+
+
+    def finish_loading(self):
+        """Waits until all assets are loaded"""
+        self.poll_assets(True)
+
+
     def init(self):
         """Initialises a game run
         """
-        start_position = self._track.get_next_starting_position()
-        self._ego = Ego(start_position[0], start_position[1], 180, self._car_image)
+        x, y = self._track.get_next_starting_position()
+        self._simulation = Simulation(self._track, self._step_dt, self._options.laps)
+        # the players start side by side
+        self._players = []
+        for i, sprites in enumerate(self._player_sprites):
+            px = x + (i - (len(self._player_sprites)-1) / 2.) * PLAYER_GAP
+            if self._track.get_floor(px, y) in DISTANCE_FLOORS:
+                px = x
+            self._players.append(self._simulation.add_vehicle(Ego(px, y, 180, self._car_image, sprites)))
+        self._ego = self._players[0]
+        if self._options.opponents>0 and self._track._racing_line is not None:
+            self._simulation.add_opponents(self._options.opponents)
+        # runs of varying step durations cannot be replayed, multiplayer runs
+        # are not recorded
+        self._replay = None
+        if self._options.physics_hz>0 and len(self._players)==1:
+            self._replay = Replay(self._scores._track, self._options.physics_hz, self._options.laps)
+        self._ghost = None
+        if self._replay is not None and not self._options.no_ghost:
+            self.load_ghost()
         self._state = INTRO_TITLE
-        self._theme_channel.play(self._theme_sound, loops=-1)    
+        if self._theme_sound is not None:
+            self._theme_channel.play(self._theme_sound, loops=-1)    
         self._start_time = pygame.time.get_ticks()
         self._engine_channel.stop()    
 
 
-    def draw(self, surface):
+    def load_ghost(self):
+        """Loads the best stored replay of the track as a ghost car
+
+        The ghost is driven by the replay's inputs in an own simulation. Only
+        replays recorded with the current simulation rate and number of laps
+        are used.
+        """
+        for path in self._scores.get_replays():
+            try:
+                replay = Replay.load(path)
+            except (OSError, ValueError):
+                continue
+            if replay._physics_hz!=self._options.physics_hz or replay._laps!=self._options.laps:
+                continue
+            x, y = self._track.get_next_starting_position()
+            self._ghost_simulation = Simulation(self._track, self._step_dt, self._options.laps)
+            self._ghost = self._ghost_simulation.add_vehicle(Vehicle(x, y, 180, self._car_image,
+                self._ghost_sprites))
+            self._ghost_inputs = replay.get_inputs()
+            return
+
+
+    def draw(self, surface, alpha=1.):
         """Performs the drawing (all screens)
+
+        alpha interpolates between the previous and the current simulation
+        step (see Vehicle.get_interpolated). Returns the list of the changed
+        rectangles of the surface.
+
+        While racing, each player's view is shown in an own part of the
+        screen (see get_viewports); the title screens show the first player's
+        one. All views are drawn from the track's render cache.
         """
-        surface.fill((0, 0, 0))
-        xs = SCR_WIDTH/2
-        ys = SCR_HEIGHT/2
-        view = Rect(-xs+self._ego._x, -ys+self._ego._y, xs+xs, ys+ys)
-        self._track.draw(surface, view)
+        screen = surface.get_rect()
+        if self._state==LOADING:
+            surface.fill((0, 0, 0))
+            self.draw_loading(surface)
+            self._profiler.mark(PHASE_HUD)
+            self.invalidate()
+            return [screen]
+        viewports = self._viewports if self._state in (BEGIN, GAME, SET_SCORE) else [screen]
+        # only the screens that show the track without an overlay are scrolled
+        keep = self._state in (BEGIN, GAME) and not self._options.full_redraw
+        incremental = keep and self._state==self._last_state
+        changed = []
+        # the minimap is opaque, the track below it is not redrawn
+        covered = None
+        if self._state in (BEGIN, GAME) and self._minimap is not None:
+            covered = self.get_minimap_rect()
+        if not incremental and len(viewports)==3:
+            surface.fill((0, 0, 0))
+        for i, viewport in enumerate(viewports):
+            part = surface.subsurface(viewport) if viewport!=screen else surface
+            vehicle = self._players[i]
+            x, y, _ = vehicle.get_interpolated(alpha) if alpha<1 else (vehicle._x, vehicle._y, 0)
+            xs = viewport.width/2
+            ys = viewport.height/2
+            view = Rect(-xs+x*self._scale, -ys+y*self._scale, xs+xs, ys+ys)
+            last_rects = self._last_rects[i] \
+                + [rect.move(-viewport.left, -viewport.top) for rect in self._last_overlays]
+            changes = self.draw_track(part, view, self._last_views[i] if incremental else None, last_rects,
+                covered.move(-viewport.left, -viewport.top) if covered is not None else None)
+            self._profiler.mark(PHASE_TRACK)
+            rects = self.draw_view(part, alpha, view, i)
+            self._profiler.mark(PHASE_HUD)
+            if keep:
+                self._last_views[i] = view
+                self._last_rects[i] = rects
+            if changes is not None:
+                changed.extend(rect.move(viewport.topleft) for rect in changes + rects)
+            else:
+                changed.append(viewport)
+        rects = self.draw_hud(surface, alpha)
+        panel = self._profiler.draw(surface, self._profile_font, self._scale)
+        if panel is not None:
+            rects.append(panel)
+        self._profiler.mark(PHASE_HUD)
+        self._last_overlays = rects
+        if keep:
+            self._last_state = self._state
+        else:
+            self.invalidate()
+        if screen in changed:
+            return [screen]
+        return changed + rects
+
+
+    def draw_track(self, surface, view, last, last_rects, covered=None):
+        """Draws the given part of the track (view)
+
+        If the part shown before (last) is given, the surface is scrolled by
+        the view's movement and only the uncovered strips and the given
+        rectangles drawn last are redrawn, but for the parts of the covered
+        rectangle (which will be drawn over). Returns the changed rectangles
+        of the surface if the surface was not moved, None if all changed.
+        """
+        screen = surface.get_rect()
+        if last is None or abs(view.left-last.left)>=screen.width or abs(view.top-last.top)>=screen.height:
+            surface.fill((0, 0, 0))
+            self._track.draw(surface, view)
+            return None
+        dx = view.left - last.left
+        dy = view.top - last.top
+        surface.scroll(-dx, -dy)
+        dirty = [rect.move(-dx, -dy) for rect in last_rects]
+        if dx>0:
+            dirty.append(Rect(screen.width-dx, 0, dx, screen.height))
+        elif dx<0:
+            dirty.append(Rect(0, 0, -dx, screen.height))
+        if dy>0:
+            dirty.append(Rect(0, screen.height-dy, screen.width, dy))
+        elif dy<0:
+            dirty.append(Rect(0, 0, screen.width, -dy))
+        if covered is not None:
+            dirty = [part for rect in dirty for part in subtract_rect(rect, covered)]
+        dirty = [rect.clip(screen) for rect in dirty]
+        dirty = [rect for rect in dirty if rect.width>0 and rect.height>0]
+        for rect in dirty:
+            surface.set_clip(rect)
+            surface.fill((0, 0, 0))
+            self._track.draw(surface, view)
+        surface.set_clip(None)
+        return None if dx or dy else dirty
+
+
+    def invalidate(self):
+        """Forces the next frame to be drawn completely"""
+        self._last_views = [None] * len(self._viewports)
+        self._last_state = None
+
+
+    def draw_loading(self, surface):
+        """Draws the loading screen
+        """
+        s = self._scale
+        img = self._font.render("Loading...", True, (255, 255, 255))
+        surface.blit(img, ((self._screen.width-img.get_width())/2, 340*s))
+        bar = Rect((self._screen.width-400*s)/2, 400*s, 400*s, 16*s)
+        pygame.draw.rect(surface, (255, 255, 255), bar, 1)
+        surface.fill((255, 255, 255),
+            (bar.left+2, bar.top+2, int((bar.width-4) * self._loader.get_progress()), bar.height-4))
+
+
+    def draw_view(self, surface, alpha, view, index):
+        """Draws the cars and the texts shown in a player's view
+
+        view is the shown part of the track, in pixels of the track drawn at
+        the render scale; the player's car is drawn at the surface's center.
+        Returns the list of the rectangles that were drawn.
+        """
+        rects = []
+        if self._state not in (BEGIN, GAME, SET_SCORE):
+            return rects
+        s = self._scale
+        if self._ghost is not None:
+            rects.append(self._ghost.draw(surface, alpha, view, s))
+        opponents = self._simulation._opponents
+        if opponents is not None:
+            rects.extend(opponents.draw(surface, view, self._npc_sprites, alpha, s))
+        for i, player in enumerate(self._players):
+            if i!=index:
+                rects.append(player.draw(surface, alpha, view, s))
+        vehicle = self._players[index]
+        width = surface.get_width()
+        left = int(20*s)
+        right = width - int(60*s)
+        if self._state==BEGIN:
+            dt = int((pygame.time.get_ticks() - self._start_time) / 1000)
+            img = self._texts.get("%s" % (3-dt))
+            rects.append(surface.blit(img, ((width-img.get_width())/2, surface.get_height()*2//5)))
+            rects.append(vehicle.draw(surface, alpha))
+        elif self._state==GAME:
+            rects.append(vehicle.draw(surface, alpha))
+            text = "{:10.2f}".format(vehicle._v*20)
+            rects.append(self._glyphs.draw(surface, text, (left, left)))
+            img = self._texts.get(" km/h")
+            rects.append(surface.blit(img, (rects[-1].right, left)))
+            text = nice_time(self._game_time)
+            rects.append(self._glyphs.draw(surface, text, (right-self._glyphs.get_width(text), left)))
+            if self._options.laps>1:
+                img = self._texts.get("Lap %s/%s" % (self._simulation.get_lap(index), self._options.laps))
+                rects.append(surface.blit(img, (left, int(70*s))))
+            if self._simulation.get_vehicle_count()>1:
+                img = self._texts.get("Pos %s/%s" % (self._simulation.get_position(index),
+                    self._simulation.get_vehicle_count()))
+                rects.append(surface.blit(img, (right-img.get_width(), int(70*s))))
+            if self._simulation.is_wrong_way(index):
+                img = self._texts.get("Wrong way!")
+                rects.append(surface.blit(img, ((width-img.get_width())/2, int(120*s))))
+        elif self._state==SET_SCORE:
+            rects.append(surface.blit(self._dim_image, (0, 0)))
+            vehicle.draw(surface, alpha)
+        return rects
+
+
+    def draw_hud(self, surface, alpha=1.):
+        """Draws the overlays of the whole screen (title, scores, name entry)
+
+        While racing, the minimap is drawn. Returns the list of the rectangles
+        that were drawn.
+        """
+        rects = []
+        s = self._scale
+        width = self._screen.width
+        if self._state in (BEGIN, GAME) and self._minimap is not None:
+            rects.append(self.draw_minimap(surface))
         if self._state==INTRO_TITLE:
-            blend_image = pygame.Surface((SCR_WIDTH, SCR_HEIGHT), pygame.SRCALPHA)
-            pygame.draw.rect(blend_image, (0, 0, 0, 100), blend_image.get_rect())
-            surface.blit(blend_image, (0, 0))
+            rects.append(surface.blit(self._dim_image, (0, 0)))
             surface.blit(self._title_image, (0, 0))
             dt = int((pygame.time.get_ticks() - self._start_time) / 1000)
             if dt>5:
                 self._state = INTRO_SCORES
                 self._start_time = pygame.time.get_ticks()
+                self._scores.refresh()
         elif self._state==INTRO_SCORES:
-            blend_image = pygame.Surface((SCR_WIDTH, SCR_HEIGHT), pygame.SRCALPHA)
-            pygame.draw.rect(blend_image, (0, 0, 0, 100), blend_image.get_rect())
-            surface.blit(blend_image, (0, 0))
-            self._scores.draw(surface, self._font)
+            rects.append(surface.blit(self._dim_image, (0, 0)))
+            self._scores.draw(surface, self._font, s)
             dt = int((pygame.time.get_ticks() - self._start_time) / 1000)
             if dt>5:
                 self._state = INTRO_TITLE
                 self._start_time = pygame.time.get_ticks()
-        elif self._state==BEGIN:
-            dt = int((pygame.time.get_ticks() - self._start_time) / 1000)
-            img = self._font.render("%s" % (3-dt), True, (255, 255, 255))
-            surface.blit(img, ((SCR_WIDTH-img.get_width())/2, 320))
-            self._ego.draw(surface)
-        elif self._state==GAME:
-            self._ego.draw(surface)
-            img = self._font.render("{:10.2f} km/h".format(self._ego._v*20), True, (255, 255, 255))
-            surface.blit(img, (20, 20))
-            level_time = pygame.time.get_ticks() - self._start_time
-            img = self._font.render(nice_time(level_time), True, (255, 255, 255))
-            surface.blit(img, (SCR_WIDTH-60-img.get_width(), 20))
+        elif self._state==SET_SCORE and len(self._players)>1:
+            players = sorted(range(len(self._players)), key=lambda i: self._simulation.get_finish_time(i))
+            for rank, i in enumerate(players):
+                finish_time = self._simulation.get_finish_time(i)
+                img = self._texts.get("%s. Player %s: %s" % (rank+1, i+1, nice_time(finish_time)))
+                surface.blit(img, ((width-img.get_width())/2, (260 + rank*60)*s))
+            img = self._texts.get("Press return")
+            surface.blit(img, ((width-img.get_width())/2, (260 + len(players)*60 + 40)*s))
         elif self._state==SET_SCORE:
-            blend_image = pygame.Surface((SCR_WIDTH, SCR_HEIGHT), pygame.SRCALPHA)
-            pygame.draw.rect(blend_image, (0, 0, 0, 100), blend_image.get_rect())
-            surface.blit(blend_image, (0, 0))
-            self._ego.draw(surface)
-            img = self._font.render("Your time: " + nice_time(self._level_time), True, (255, 255, 255))
-            surface.blit(img, ((SCR_WIDTH-img.get_width())/2, 320))
-            img = self._font.render("Please enter your name:", True, (255, 255, 255))
-            surface.blit(img, ((SCR_WIDTH-img.get_width())/2, 380))
-            img = self._font.render(self._current_name, True, (255, 255, 255))
-            surface.blit(img, ((SCR_WIDTH-img.get_width())/2, 440))
+            img = self._texts.get("Your time: " + nice_time(self._level_time))
+            surface.blit(img, ((width-img.get_width())/2, 320*s))
+            img = self._texts.get("Please enter your name:")
+            surface.blit(img, ((width-img.get_width())/2, 380*s))
+            img = self._texts.get(self._current_name)
+            surface.blit(img, ((width-img.get_width())/2, 440*s))
+        return rects
+
+
+    def get_minimap_rect(self):
+        """Returns the screen's part the minimap is shown in"""
+        margin = int(MINIMAP_MARGIN*self._scale)
+        rect = self._minimap.get_rect()
+        rect.bottomright = (self._screen.width-margin, self._screen.height-margin)
+        return rect
+
+
+    def draw_minimap(self, surface):
+        """Draws the minimap into the screen's bottom right corner
+
+        The track's image is rendered once (see render_minimap), only the
+        vehicles' markers are drawn each frame. Returns the rectangle that
+        was drawn.
+        """
+        rect = surface.blit(self._minimap, self.get_minimap_rect())
+        fx = rect.width / float(self._width * SIZE)
+        fy = rect.height / float(self._height * SIZE)
+        size = max(2, int(MINIMAP_MARKER*self._scale))
+        marker = Rect(0, 0, size, size)
+        opponents = self._simulation._opponents
+        if opponents is not None:
+            batch = opponents._batch
+            for x, y in zip(batch._x.tolist(), batch._y.tolist()):
+                marker.center = (rect.left + int(x*fx), rect.top + int(y*fy))
+                surface.fill(NPC_TINT, marker.clip(rect))
+        for i in reversed(range(len(self._players))):
+            player = self._players[i]
+            marker.center = (rect.left + int(player._x*fx), rect.top + int(player._y*fy))
+            surface.fill(PLAYER_TINTS[i], marker.clip(rect))
+        return rect
             
 
     def process_keys(self, dt):
         """Processes the key inputs
+
+        Returns the inputs for each player's vehicle (combinations of the
+        INPUT_* bits), read from the player's keys (see PLAYER_KEYS). A single
+        player may use both, the cursor keys and WASD.
         """
+        inputs = [0] * len(self._players)
         if self._state==INTRO_TITLE or self._state==INTRO_SCORES:
             if pygame.K_SPACE in self._pressed_keys:
                 self._state = BEGIN
                 self._start_time = pygame.time.get_ticks()
                 self._theme_channel.stop()    
-                self._engine_channel.play(self._engine_sound, loops=-1)    
+                if self._engine_sound is not None:
+                    self._engine_channel.play(self._engine_sound, loops=-1)    
             elif pygame.K_ESCAPE in self._pressed_keys:
                 self._quit = True
+        elif self._state==LOADING:
+            if pygame.K_ESCAPE in self._pressed_keys:
+                self._quit = True
         elif self._state==BEGIN:
             dt = int((pygame.time.get_ticks() - self._start_time) / 1000)
             if dt>2:
                 self._state = GAME
                 self._start_time = pygame.time.get_ticks()    
+                self._game_time = 0
         elif self._state==GAME:
-            k_left = pygame.K_LEFT in self._pressed_keys or pygame.K_a in self._pressed_keys
-            k_right = pygame.K_RIGHT in self._pressed_keys or pygame.K_d in self._pressed_keys
-            k_up = pygame.K_UP in self._pressed_keys or pygame.K_w in self._pressed_keys
-            k_down = pygame.K_DOWN in self._pressed_keys or pygame.K_s in self._pressed_keys
-            if k_left and not k_right:
-                self._ego.steer(dt, 5)
-            if k_right and not k_left:
-                self._ego.steer(dt, -5)
-            if k_up and not k_down:
-                self._ego.accel(dt, 1)
-            if k_down and not k_up:
-                self._ego.accel(dt, -1)
+            keys = [[keys] for keys in PLAYER_KEYS[:len(self._players)]]
+            if len(self._players)==1:
+                keys[0].append(PLAYER_KEYS[1])
+            for i, player_keys in enumerate(keys):
+                k_left = any(k[0] in self._pressed_keys for k in player_keys)
+                k_right = any(k[1] in self._pressed_keys for k in player_keys)
+                k_up = any(k[2] in self._pressed_keys for k in player_keys)
+                k_down = any(k[3] in self._pressed_keys for k in player_keys)
+                inputs[i] = (INPUT_LEFT if k_left else 0) | (INPUT_RIGHT if k_right else 0) \
+                    | (INPUT_UP if k_up else 0) | (INPUT_DOWN if k_down else 0)
             if pygame.K_ESCAPE in self._pressed_keys:
                 self._state = INTRO_TITLE
                 self._pressed_keys.remove(pygame.K_ESCAPE)
                 self.init()
+                inputs = [0] * len(self._players)
+        return inputs
+
+
+    def step(self, dt):
+        """Performs a simulation step
+
+        The race time is the sum of the steps' durations, so that it does not
+        depend on the frame rate if the steps have a fixed duration.
+        """
+        inputs = self.process_keys(dt)
+        self._profiler.mark(PHASE_KEYS)
+        if self._state==LOADING:
+            return
+        if self._state==GAME:
+            self._game_time += dt * 1000.
+            if self._replay is not None:
+                self._replay.record(inputs[0])
+            if self._ghost is not None:
+                self._ghost_simulation.step([next(self._ghost_inputs, 0)], dt)
+        # the opponents wait for the countdown
+        if self._state in (GAME, SET_SCORE):
+            self._simulation.step(inputs, dt)
+        if all(self._simulation.get_finish_time(i) is not None for i in range(len(self._players))):
+            self.track_finished()
+        if self._engine_sound is not None:
+            self._engine_sound.set_volume(max(.2, .2+.8*min(150, self._ego._v*20)/150.))
+        self._profiler.mark(PHASE_STEP)
 
 
     def track_finished(self):
         """Closes the gaming mode, moves to user name entry
+
+        In multiplayer games, the results are shown instead when all players
+        finished.
         """
         if self._state==SET_SCORE:
             return 
         self._current_name = ""
         self._pressed_keys = set()
         self._state = SET_SCORE
-        self._level_time = pygame.time.get_ticks() - self._start_time
+        self._level_time = int(self._game_time)
         self._start_time = pygame.time.get_ticks()
+        if self._replay is not None:
+            self._replay._finish_time = self._simulation.get_finish_time(0)
+
+
+    def save_score(self):
+        """Adds the entered name and the time to the scores, together with the run's replay
+
+        Multiplayer games are not added.
+        """
+        if len(self._players)>1:
+            return
+        self._scores.add(self._current_name, self._level_time, replay=self._replay)
                 
 
 # --- main function ---------------------------------------------------------
-def main(args=None):
-    pygame.init()
-    pygame.mixer.init()
-    game = Game()
-    surface = pygame.display.set_mode((SCR_WIDTH, SCR_HEIGHT))
+def verify_replays(options):
+    """Re-simulates replays and checks them against the scores
+
+    A replay is valid if it was recorded on the track, its inputs finish the
+    race in the recorded time and the scores hold an entry of the player with
+    this time. Returns the number of invalid replays.
+    """
+    path = get_data_path()
+    track_path = options.track if options.track else os.path.join(path, "gfx", "track01.png")
+    track_name = os.path.splitext(os.path.basename(track_path))[0]
+    track = load_track(track_path, options.chunk_size, options.max_chunks, options.max_track_chunks,
+        None if options.no_cache else options.cache_dir)
+    scores = Scores(path, track_name)
+    paths = options.verify_replays if options.verify_replays else scores.get_replays()
+    failed = 0
+    steps = 0
+    simulated = 0.
+    t0 = time.perf_counter()
+    for replay_path in paths:
+        try:
+            replay = Replay.load(replay_path)
+        except (OSError, ValueError) as e:
+            error = str(e)
+        else:
+            steps += len(replay)
+            simulated += len(replay) / replay._physics_hz
+            finish_time = replay.verify(track) if replay._track==track_name else None
+            if replay._track!=track_name:
+                error = "recorded on track '%s'" % replay._track
+            elif finish_time is None:
+                error = "does not finish"
+            elif finish_time!=replay._finish_time:
+                error = "finishes in %s instead of %s" % (finish_time, replay._finish_time)
+            elif [replay._name, finish_time] not in scores.get_top(None):
+                error = "no score entry for '%s' with %s" % (replay._name, finish_time)
+            else:
+                error = None
+        if error is not None:
+            failed += 1
+            print("%s: %s" % (replay_path, error))
+    duration = time.perf_counter() - t0
+    print("%s of %s replays valid; %s steps in %.2f s (%.0fx real time)" % (len(paths)-failed, len(paths),
+        steps, duration, simulated / duration if duration>0 else 0))
+    return failed
+
+
+def parse_options(args=None):
+    """Parses the command line options
+    """
+    parser = argparse.ArgumentParser(prog="tempo120", description="A party car racing game")
+    parser.add_argument("--track", default=None,
+                        help="the track to drive, an image or a tiled track file; "
+                             "gfx/track01.png by default")
+    parser.add_argument("--convert-track", nargs=2, metavar=("IMAGE", "TILED"), default=None,
+                        help="convert a track image into a tiled track file and exit")
+    parser.add_argument("--laps", type=int, default=1,
+                        help="number of laps to drive")
+    parser.add_argument("--players", type=int, default=1,
+                        help="number of players (1-4) sharing the screen; player 1 uses the cursor keys, "
+                             "2 WASD, 3 IJKL and 4 the numpad")
+    parser.add_argument("--opponents", type=int, default=0,
+                        help="number of AI opponents; not available on tiled tracks")
+    parser.add_argument("--max-track-chunks", type=int, default=MAX_TRACK_CHUNKS,
+                        help="maximum number of chunks of a tiled track file kept in memory")
+    parser.add_argument("--cache-dir", default=get_cache_dir(),
+                        help="directory to store the compiled track and decoded sounds in")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="neither read nor write compiled assets")
+    parser.add_argument("--compact-scores", action="store_true",
+                        help="rewrite the scores file sorted and without corrupt lines and exit")
+    parser.add_argument("--verify-replays", nargs="*", metavar="REPLAY", default=None,
+                        help="re-simulate the given replays (all stored ones of the track if none are "
+                             "given), check them against the scores and exit")
+    parser.add_argument("--no-ghost", action="store_true",
+                        help="do not show the best stored run of the track as a ghost car")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the track and the sounds into the cache directory and exit")
+    parser.add_argument("--timing", action="store_true",
+                        help="report the time needed until the title screen is shown")
+    parser.add_argument("--loader-threads", type=int, default=LOADER_THREADS,
+                        help="number of threads that load the assets")
+    parser.add_argument("--no-background-loading", action="store_true",
+                        help="load all assets before showing the window")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="size of the pre-rendered track chunks in pixels; "
+                             "0 draws the tiles one by one")
+    parser.add_argument("--max-chunks", type=int, default=MAX_CHUNKS,
+                        help="maximum number of pre-rendered track chunks kept in memory")
+    parser.add_argument("--sprite-resolution", type=float, default=SPRITE_RESOLUTION,
+                        help="angular resolution of the cached car rotations in degrees")
+    parser.add_argument("--smooth-sprites", action="store_true",
+                        help="anti-alias the cached car rotations")
+    parser.add_argument("--prebuild-sprites", action="store_true",
+                        help="compute all car rotations at start instead of when needed")
+    parser.add_argument("--physics-hz", type=int, default=PHYSICS_HZ,
+                        help="simulation steps per second; "
+                             "0 performs one step of varying duration per frame")
+    parser.add_argument("--fps", type=int, default=FPS,
+                        help="maximum frames per second; 0 does not limit the frame rate")
+    parser.add_argument("--render-scale", type=float, default=RENDER_SCALE,
+                        help="draw the game at this fraction of its resolution and scale it up to the "
+                             "window (.5 halves it)")
+    parser.add_argument("--fullscreen", action="store_true",
+                        help="show the game on the full screen")
+    parser.add_argument("--no-minimap", action="store_true",
+                        help="do not show the minimap while racing")
+    parser.add_argument("--full-redraw", action="store_true",
+                        help="redraw and update the complete screen each frame "
+                             "instead of scrolling the previous one")
+    parser.add_argument("--vsync", action="store_true",
+                        help="synchronise the display updates with the monitor")
+    parser.add_argument("--idle", choices=["sleep", "busy"], default="sleep",
+                        help="how to wait for the next frame: sleep (saves CPU) or busy (more accurate)")
+    parser.add_argument("--profile-out", default=None,
+                        help="save the durations of the last frames' phases to this file "
+                             "(.csv or .json) on exit")
+    options = parser.parse_args(args)
+    tiled = options.track is not None and os.path.isfile(options.track) and is_tiled_track(options.track)
+    if options.opponents>0 and tiled:
+        parser.error("tiled tracks have no racing line, so there cannot be opponents")
+    return options
+
+
+def open_display(options):
+    """Opens the game's window and returns the surface to draw on
+
+    If the game is drawn at a lower render scale, the surface is smaller and
+    the display scales it up to the window's usual size or, using
+    --fullscreen, to the full screen. A scaled window is only enlarged by
+    whole factors that fit the desktop; if it stays smaller, the window is
+    opened at its usual size and the returned surface is an own one, scaled
+    up when the display is updated (see update_display).
+    """
+    tile_size, size = get_render_size(options.render_scale)
+    vsync = 1 if options.vsync else 0
+    if options.fullscreen:
+        surface = pygame.display.set_mode(size, pygame.FULLSCREEN | pygame.SCALED, vsync=vsync)
+    elif tile_size!=SIZE or options.vsync:
+        surface = pygame.display.set_mode(size, pygame.SCALED, vsync=vsync)
+        if pygame.display.get_window_size()[0]<SCR_WIDTH:
+            # the scaled window's renderer cannot be reused for another size;
+            # vsync needs a scaled window, which keeps the usual size
+            pygame.display.quit()
+            pygame.display.init()
+            pygame.display.set_mode((SCR_WIDTH, SCR_HEIGHT), pygame.SCALED if vsync else 0, vsync=vsync)
+            surface = pygame.Surface(size).convert()
+    else:
+        surface = pygame.display.set_mode(size)
     surface.fill((0, 0, 0))
     pygame.display.set_caption("Tempo120")
+    return surface
 
+
+def update_display(surface, rects):
+    """Shows the given changed rectangles of the surface opened by open_display
+
+    A surface that is not the display's one is scaled up to the window
+    completely if anything changed.
+    """
+    window = pygame.display.get_surface()
+    if surface is window:
+        pygame.display.update(rects)
+    elif rects:
+        pygame.transform.scale(surface, window.get_size(), window)
+        pygame.display.flip()
+
+
+def run(game, surface, options, t0=None):
+    """Runs the game's main loop until the game is quit
+
+    t0 is the time the program was started at, used for --timing.
+    """
+    clock = pygame.time.Clock()
+    step_dt = 1. / options.physics_hz if options.physics_hz>0 else 0
+    accumulator = 0.
+    profiler = game._profiler
     t1 = pygame.time.get_ticks()
     while not game._quit:
         t2 = pygame.time.get_ticks()
         dt = (t2 - t1) / 1000.
+        t1 = t2
         for event in pygame.event.get():              
             if event.type==QUIT:
-                pygame.quit()
-                sys.exit()
+                game._quit = True
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                game.invalidate()
+            if event.type==pygame.KEYDOWN and event.key==pygame.K_F3:
+                profiler.toggle()
+                continue
             if event.type==pygame.KEYDOWN:
                 game._pressed_keys.add(event.key)
                 if game._state==SET_SCORE:
                     if event.key==pygame.K_BACKSPACE:
                         game._current_name = game._current_name[:-1]
                     elif event.key==pygame.K_RETURN:
-                        game._scores.add(game._current_name, game._level_time)
+                        game.save_score()
                         game.init()
                     else:
                         game._current_name += event.unicode
                         if len(game._current_name)>16: game._current_name = game._current_name[:16]
             if event.type==pygame.KEYUP and event.key in game._pressed_keys:
                 game._pressed_keys.remove(event.key)
-        game.process_keys(dt)
-        game._ego.step(game, dt)
-        game.draw(surface)
-        pygame.display.update()
-        t1 = t2
+        game.poll_assets()
+        profiler.mark(PHASE_EVENTS)
+        if step_dt>0:
+            # fixed steps; the rest of the elapsed time is carried over
+            accumulator += min(dt, MAX_FRAME_TIME)
+            while accumulator>=step_dt:
+                game.step(step_dt)
+                accumulator -= step_dt
+            alpha = accumulator / step_dt
+        else:
+            game.step(dt)
+            alpha = 1.
+        rects = game.draw(surface, alpha)
+        update_display(surface, rects)
+        profiler.mark(PHASE_UPDATE)
+        if options.timing and t0 is not None and game._state==INTRO_TITLE:
+            print("Time to title screen: %.1f ms" % ((time.perf_counter() - t0) * 1000.))
+            t0 = None
+        if options.fps>0:
+            if options.idle=="busy":
+                clock.tick_busy_loop(options.fps)
+            else:
+                clock.tick(options.fps)
+        profiler.end_frame()
+    if options.profile_out:
+        profiler.save(options.profile_out)
+
+
+def main(args=None):
+    t0 = time.perf_counter()
+    options = parse_options(args)
+    if options.convert_track:
+        convert_track(pygame.image.load(options.convert_track[0]), options.convert_track[1])
+        return
+    if options.compact_scores:
+        Scores(get_data_path()).save()
+        return
+    if options.verify_replays is not None:
+        return 1 if verify_replays(options) else 0
+    pygame.init()
+    pygame.mixer.init()
+    if options.compile:
+        Game(options).finish_loading()
+        pygame.mixer.quit()
+        return
+    surface = open_display(options)
+    run(Game(options), surface, options, t0)
     pygame.mixer.quit()
 
 
 # -- main check
 if __name__ == '__main__':
-    main(sys.argv) # pragma: no cover
+    sys.exit(main(sys.argv[1:])) # pragma: no cover
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+# ===========================================================================
+"""tempo120 - Benchmarks for rendering, physics and loading."""
+# ===========================================================================
+__author__     = "Daniel Krajzewicz"
+__copyright__  = "Copyright 2023-2024, Daniel Krajzewicz"
+__credits__    = ["Daniel Krajzewicz"]
+__license__    = "GPL 3.0"
+__version__    = "1.8.0"
+__maintainer__ = "Daniel Krajzewicz"
+__email__      = "daniel@krajzewicz.de"
+__status__     = "Production"
+# ===========================================================================
+# - https://github.com/dkrajzew/tempo120
+# - http://www.krajzewicz.de
+# ===========================================================================
+
+
+# --- imports ---------------------------------------------------------------
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pygame
+import tempo120
+
+
+# --- constants -------------------------------------------------------------
+SIZES = [1024, 4096, 8192]
+TOLERANCE = .2
+
+
+# --- helper methods --------------------------------------------------------
+def make_track_image(size):
+    """Builds a synthetic track image of size x size tiles
+
+    The track is a rectangular loop, surrounded by tires, with the start
+    position and the goal line on its left side and tires between them.
+    """
+    image = pygame.Surface((size, size))
+    image.fill(tempo120.TILE_GRASS)
+    border = max(4, size // 16)
+    width = max(3, size // 64)
+    loop = pygame.Rect(border, border, size-2*border, size-2*border)
+    pygame.draw.rect(image, tempo120.TILE_TIRES, loop.inflate(2*width+8, 2*width+8), 1)
+    pygame.draw.rect(image, tempo120.TILE_TRACK, loop.inflate(width, width), width)
+    pygame.draw.rect(image, tempo120.TILE_TIRES, loop.inflate(-width-8, -width-8), 1)
+    y = size // 2
+    x0 = loop.left - width // 2
+    pygame.draw.line(image, tempo120.TILE_TIRES, (x0, y), (x0+width, y))
+    pygame.draw.line(image, tempo120.TILE_GOAL, (x0, y+1), (x0+width, y+1))
+    image.set_at((loop.left, y-2), tempo120.TILE_START)
+    return image
+
+
+def measure(function, repeat, number=1, per=1):
+    """Calls the function number times per run, repeat runs
+
+    Returns the statistics of the durations in ms per call, divided by per
+    (the number of operations a call performs).
+    """
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        durations.append((time.perf_counter() - t0) * 1000. / number / per)
+    return {"min": min(durations), "median": float(np.median(durations)),
+        "mean": float(np.mean(durations)), "runs": repeat}
+
+
+# --- benchmarks ------------------------------------------------------------
+def bench_track(results, name, image, repeat):
+    """Benchmarks loading and drawing the given track image"""
+    results["track_init[%s]" % name] = measure(lambda: tempo120.Track(image.copy()), max(1, repeat // 4))
+    track = tempo120.Track(image.copy())
+    surface = pygame.display.get_surface()
+    x, y = track.get_next_starting_position()
+    positions = [(x - tempo120.SCR_WIDTH/2 + i*37, y - tempo120.SCR_HEIGHT/2 - i*23) for i in range(50)]
+    def draw(track=track):
+        for px, py in positions:
+            track.draw(surface, pygame.Rect(px, py, tempo120.SCR_WIDTH, tempo120.SCR_HEIGHT))
+    draw()
+    results["track_draw[%s]" % name] = measure(draw, repeat, per=len(positions))
+    results["minimap_render[%s]" % name] = measure(
+        lambda: tempo120.render_minimap(track._grid, tempo120.MINIMAP_SIZE), max(1, repeat // 4))
+    if image.get_width()<=1024:
+        tiles = tempo120.Track(image.copy(), 0)
+        def draw_tiles():
+            tiles.draw(surface, pygame.Rect(positions[0][0], positions[0][1],
+                tempo120.SCR_WIDTH, tempo120.SCR_HEIGHT))
+        results["track_draw_tiles[%s]" % name] = measure(draw_tiles, repeat)
+
+
+def bench_vehicle(results, game, repeat):
+    """Benchmarks drawing and stepping a vehicle"""
+    surface = pygame.display.get_surface()
+    x, y = game._track.get_next_starting_position()
+    vehicle = tempo120.Vehicle(x, y, 180, game._car_image, game._car_sprites)
+    def draw():
+        for i in range(360):
+            vehicle._o = i
+            vehicle.draw(surface)
+    draw()
+    results["vehicle_draw"] = measure(draw, repeat, per=360)
+    def step():
+        vehicle._x, vehicle._y, vehicle._o, vehicle._v = x, y, 180, 0
+        for i in range(1000):
+            vehicle.control(1./60, tempo120.INPUT_UP | (tempo120.INPUT_LEFT if i%3==0 else 0))
+            vehicle.step(game._track, 1./60)
+    results["vehicle_step"] = measure(step, repeat, per=1000)
+    if game._track._racing_line is not None:
+        def step_opponents():
+            simulation = tempo120.Simulation(game._track)
+            simulation.add_opponents(20)
+            for _ in range(1000):
+                simulation.step([])
+        results["opponents_step[20]"] = measure(step_opponents, max(1, repeat // 4), per=1000)
+
+
+def bench_game(results, game, repeat):
+    """Benchmarks drawing the game in its different states"""
+    surface = pygame.display.get_surface()
+    game._level_time = 123456
+    game._current_name = "benchmark"
+    for state, name in ((tempo120.INTRO_TITLE, "INTRO_TITLE"), (tempo120.INTRO_SCORES, "INTRO_SCORES"),
+            (tempo120.GAME, "GAME"), (tempo120.SET_SCORE, "SET_SCORE")):
+        def draw():
+            game._state = state
+            game._start_time = pygame.time.get_ticks()
+            game.draw(surface)
+        draw()
+        results["game_draw[%s]" % name] = measure(draw, repeat, 10)
+    # four players, each view moving
+    players = tempo120.Game(tempo120.parse_options(["--players", "4"]))
+    players.finish_loading()
+    players._state = tempo120.GAME
+    def draw_players():
+        for vehicle in players._players:
+            vehicle._x += 3
+        players.draw(surface)
+    draw_players()
+    results["game_draw[GAME, 4 players]"] = measure(draw_players, repeat, 10)
+    def draw_player():
+        game._ego._x += 3
+        game.draw(surface)
+    game._state = tempo120.GAME
+    results["game_draw[GAME, moving]"] = measure(draw_player, repeat, 10)
+    # drawing at half the resolution and without the minimap
+    for name, args in (("render scale .5", ["--render-scale", ".5"]), ("no minimap", ["--no-minimap"])):
+        other = tempo120.Game(tempo120.parse_options(args))
+        other.finish_loading()
+        other._state = tempo120.GAME
+        target = pygame.Surface(other._screen.size).convert()
+        def draw_other(other=other, target=target):
+            other._ego._x += 3
+            other.draw(target)
+        draw_other()
+        results["game_draw[GAME, moving, %s]" % name] = measure(draw_other, repeat, 10)
+
+
+def bench_scores(results, repeat):
+    """Benchmarks loading and extending the high scores"""
+    path = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(path, "scores"))
+        with open(os.path.join(path, "scores", "scores.txt"), "w") as fd:
+            for i in range(15):
+                fd.write("player%s\t%s\n" % (i, 60000+i*1000))
+        scores = tempo120.Scores(path)
+        results["scores_load"] = measure(scores.load, repeat, 10)
+        times = iter(range(10**9))
+        results["scores_add"] = measure(lambda: scores.add("bench", 50000 + next(times)), repeat, 10)
+    finally:
+        shutil.rmtree(path)
+
+
+def compare(results, baseline, tolerance):
+    """Compares the medians against the ones of the baseline
+
+    Returns the names of the benchmarks that got slower by more than the
+    tolerance (a fraction).
+    """
+    slower = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]["median"]
+        ratio = result["median"] / before if before>0 else 1.
+        flag = ""
+        if ratio>1+tolerance:
+            slower.append(name)
+            flag = "  SLOWER"
+        print("%-32s %10.4f ms %10.4f ms %7.2fx%s" % (name, before, result["median"], ratio, flag))
+    return slower
+
+
+# --- main function ---------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="tempo120_bench", description="Benchmarks tempo120")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="comma separated sizes of the synthetic tracks in tiles")
+    parser.add_argument("--repeat", type=int, default=20, help="number of runs per benchmark")
+    parser.add_argument("--output", default=None, help="write the results as JSON into this file")
+    parser.add_argument("--baseline", default=None,
+                        help="compare the results to the ones stored in this file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="allowed slow down against the baseline as a fraction")
+    options = parser.parse_args(args)
+
+    results = {}
+    pygame.init()
+    pygame.mixer.init()
+    pygame.display.set_mode((tempo120.SCR_WIDTH, tempo120.SCR_HEIGHT))
+    results["game_init"] = measure(lambda: tempo120.Game().finish_loading(), 1)
+    game = tempo120.Game()
+    game.finish_loading()
+    path = os.path.dirname(os.path.abspath(tempo120.__file__))
+    image = pygame.image.load(os.path.join(path, "gfx", "track01.png"))
+    bench_track(results, "track01", image, options.repeat)
+    for size in [int(s) for s in options.sizes.split(",") if s]:
+        image = make_track_image(size)
+        bench_track(results, size, image, max(2, options.repeat // 4))
+        del image
+    bench_vehicle(results, game, options.repeat)
+    bench_game(results, game, options.repeat)
+    bench_scores(results, options.repeat)
+    pygame.quit()
+
+    report = {"version": tempo120.__version__, "python": platform.python_version(),
+        "pygame": pygame.version.ver, "platform": platform.platform(), "results": results}
+    if options.output:
+        with open(options.output, "w") as fd:
+            json.dump(report, fd, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+    if options.baseline:
+        with open(options.baseline) as fd:
+            baseline = json.load(fd)["results"]
+        slower = compare(results, baseline, options.tolerance)
+        if slower:
+            print("%s benchmark(s) got slower: %s" % (len(slower), ", ".join(slower)))
+            return 1
+    return 0
+
+
+# -- main check
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:])) # pragma: no cover
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+# ===========================================================================
+"""tempo120 - Environments for training driving agents."""
+# ===========================================================================
+__author__     = "Daniel Krajzewicz"
+__copyright__  = "Copyright 2023-2024, Daniel Krajzewicz"
+__credits__    = ["Daniel Krajzewicz"]
+__license__    = "GPL 3.0"
+__version__    = "1.8.0"
+__maintainer__ = "Daniel Krajzewicz"
+__email__      = "daniel@krajzewicz.de"
+__status__     = "Production"
+# ===========================================================================
+# - https://github.com/dkrajzew/tempo120
+# - http://www.krajzewicz.de
+# ===========================================================================
+
+
+# --- imports ---------------------------------------------------------------
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import multiprocessing
+import sys
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import tempo120
+
+
+# --- constants -------------------------------------------------------------
+PATCH_SIZE = 15
+MAX_STEPS = 60 * 60 * 5
+ACTIONS = 16
+STATE_FIELDS = ["x", "y", "sin", "cos", "speed", "progress"]
+
+
+# --- helper methods --------------------------------------------------------
+def load_track(path=None, cache_dir=None):
+    """Loads the track for an environment, track01 by default"""
+    if path is None:
+        path = os.path.join(tempo120.get_data_path(), "gfx", "track01.png")
+    return tempo120.load_track(path, cache_dir=cache_dir)
+
+
+def get_buffers(n, patch_size=PATCH_SIZE, buffer=None):
+    """Returns the arrays an environment of n vehicles writes its results into
+
+    The arrays are laid out one after the other within the given buffer (e.g.
+    a shared memory block) or newly allocated. Returns a dict of the arrays
+    and the number of bytes they need.
+    """
+    layout = [("state", np.float32, (n, len(STATE_FIELDS))),
+        ("patch", np.uint8, (n, patch_size, patch_size)), ("reward", np.float32, (n,)),
+        ("terminated", np.bool_, (n,)), ("truncated", np.bool_, (n,)), ("action", np.uint8, (n,))]
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in layout:
+        offset = (offset + 7) // 8 * 8
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if buffer is not None:
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        else:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        offset += size
+    return arrays, offset
+
+
+# --- classes ---------------------------------------------------------------
+class BatchEnv:
+    """n vehicles racing on a track independently of each other
+
+    The vehicles are simulated as a tempo120.VehicleBatch. Their laps are
+    validated like in tempo120.Simulation (the checkpoints have to be passed
+    on the track), so cutting across the grass does not pay off.
+
+    An action is a combination of the tempo120.INPUT_* bits (0-15). The
+    observations are a dict of arrays: "state" holds the position in tiles,
+    the sine and cosine of the heading, the speed and the validated progress
+    (1 is the finished race) per vehicle (see STATE_FIELDS), "patch" the
+    floor types (tempo120.FLOOR_*) of the patch_size x patch_size tiles
+    around each vehicle, not rotated; tiles outside the track are tires.
+    The reward is the validated distance driven in the step in tiles. An
+    episode terminates when the race is finished and is truncated after
+    max_steps. Finished vehicles are reset at once; the returned
+    observations are the ones of the new episode then.
+
+    The results are written into the arrays given by get_buffers; the
+    returned arrays are these, so they are overwritten by the next step.
+    """
+
+    def __init__(self, track, n, laps=1, dt=1./tempo120.PHYSICS_HZ, patch_size=PATCH_SIZE,
+            max_steps=MAX_STEPS, buffers=None, checkpoints=tempo120.CHECKPOINTS):
+        """Initialises the environment
+
+        Raises a ValueError if the track has no progress field.
+        """
+        if track._progress is None:
+            raise ValueError("The track has no progress field.")
+        self._track = track
+        self._laps = laps
+        self._dt = dt
+        self._max_steps = max_steps
+        self._buffers = buffers if buffers is not None else get_buffers(n, patch_size)[0]
+        self._checkpoints = np.array([track._length * (i+1) // (checkpoints+1)
+            for i in range(checkpoints)], dtype=np.int64)
+        self._start = track.get_next_starting_position()
+        # the floors are padded by tires, so that each patch is a view of it
+        r = patch_size // 2
+        padded = np.pad(np.asarray(track._grid), r, constant_values=tempo120.FLOOR_TIRES)
+        self._patches = np.lib.stride_tricks.sliding_window_view(padded, (patch_size, patch_size))
+        self._batch = tempo120.VehicleBatch(n)
+        self._progress = np.zeros(n, dtype=np.int64)
+        self._passed = np.zeros(n, dtype=np.int64)
+        self._lap = np.zeros(n, dtype=np.int64)
+        self._distance = np.zeros(n, dtype=np.int64)
+        self._steps = np.zeros(n, dtype=np.int64)
+        self.reset()
+
+
+    def __len__(self):
+        """Returns the number of vehicles"""
+        return len(self._batch)
+
+
+    def reset(self, mask=None):
+        """Moves the vehicles (all or the ones selected by the mask) to the start
+
+        Returns the observations and an (empty) info dict.
+        """
+        mask = slice(None) if mask is None else mask
+        batch = self._batch
+        batch._x[mask], batch._y[mask], batch._o[mask] = self._start[0], self._start[1], 180
+        batch._v[mask] = 0
+        batch._do[mask] = 0
+        batch._offtrack[mask] = 0
+        batch._finished[mask] = False
+        self._progress[mask] = 0
+        self._passed[mask] = 0
+        self._lap[mask] = 0
+        self._distance[mask] = 0
+        self._steps[mask] = 0
+        return self.observe(), {}
+
+
+    def get_tiles(self):
+        """Returns the indices (x, y) of the tiles the vehicles are on"""
+        grid = self._track._grid
+        batch = self._batch
+        xi = np.clip(np.trunc(batch._x / tempo120.SIZE).astype(np.intp), 0, grid.shape[1]-1)
+        yi = np.clip(np.trunc(batch._y / tempo120.SIZE).astype(np.intp), 0, grid.shape[0]-1)
+        return xi, yi
+
+
+    def observe(self):
+        """Writes the vehicles' observations into the buffers and returns them"""
+        batch = self._batch
+        state = self._buffers["state"]
+        a = np.radians(batch._o)
+        state[:, 0] = batch._x / tempo120.SIZE
+        state[:, 1] = batch._y / tempo120.SIZE
+        state[:, 2] = np.sin(a)
+        state[:, 3] = np.cos(a)
+        state[:, 4] = batch._v
+        state[:, 5] = self._distance / float(self._laps * self._track._length)
+        xi, yi = self.get_tiles()
+        self._buffers["patch"][:] = self._patches[yi, xi]
+        return {"state": state, "patch": self._buffers["patch"]}
+
+
+    def step(self, actions=None):
+        """Performs a simulation step using the given actions
+
+        The actions are read from the buffers if none are given. Returns the
+        observations, the rewards, whether the episodes terminated or were
+        truncated and an info dict holding the laps, like gymnasium's
+        vectorised environments.
+        """
+        actions = self._buffers["action"] if actions is None else actions
+        batch = self._batch
+        track = self._track
+        length = track._length
+        checkpoints = self._checkpoints
+        xi, yi = self.get_tiles()
+        progress = track._progress[yi, xi]
+        batch._stop_at_goal = (self._lap+1>=self._laps) & (self._passed==len(checkpoints))
+        floors = batch.step(track, self._dt, actions)
+        # see Simulation.advance and Simulation.cross_goal
+        last = self._progress
+        on_track = (progress>=0) & (progress<length)
+        valid = on_track & (progress>last) & (progress<=last+tempo120.MAX_PROGRESS_JUMP) \
+            & (self._passed<len(checkpoints))
+        valid &= checkpoints[np.minimum(self._passed, len(checkpoints)-1)]>last
+        passed = np.maximum(self._passed, np.searchsorted(checkpoints, progress, "right"))
+        self._passed = np.where(valid, passed, self._passed)
+        self._progress = np.where(on_track, progress, last)
+        crossing = (floors==tempo120.FLOOR_GOAL) & (self._passed==len(checkpoints))
+        self._lap[crossing] += 1
+        self._passed[crossing] = 0
+        self._progress[crossing] = 0
+        if not track._circuit:
+            back = crossing & (self._lap<self._laps)
+            batch._x[back], batch._y[back], batch._o[back] = self._start[0], self._start[1], 180
+            batch._do[back] = 0
+        bounded = np.minimum(self._progress, checkpoints[np.minimum(self._passed, len(checkpoints)-1)])
+        bounded = np.where(self._passed<len(checkpoints), bounded, self._progress)
+        distance = self._lap * length + bounded
+        self._buffers["reward"][:] = distance - self._distance
+        self._distance = distance
+        self._steps += 1
+        terminated = self._buffers["terminated"]
+        truncated = self._buffers["truncated"]
+        terminated[:] = self._lap>=self._laps
+        truncated[:] = ~terminated & (self._steps>=self._max_steps)
+        info = {"lap": np.minimum(self._lap + 1, self._laps)}
+        done = terminated | truncated
+        if done.any():
+            self.reset(done)
+        else:
+            self.observe()
+        return {"state": self._buffers["state"], "patch": self._buffers["patch"]}, \
+            self._buffers["reward"], terminated, truncated, info
+
+
+
+
+def _worker(connection, name, n, first, count, track_path, cache_dir, laps, dt, patch_size, max_steps):
+    """Runs the environments first to first+count of a VecEnv
+
+    The results are written into the shared memory block of the given name.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        arrays, _ = get_buffers(n, patch_size, memory.buf)
+        shard = {key: array[first:first+count] for key, array in arrays.items()}
+        env = BatchEnv(load_track(track_path, cache_dir), count, laps, dt, patch_size, max_steps, shard)
+        connection.send(None)
+        while True:
+            command = connection.recv()
+            if command=="step":
+                env.step()
+            elif command=="reset":
+                env.reset()
+            else:
+                break
+            connection.send(None)
+        del env, shard, arrays
+    except Exception as e:
+        connection.send(e)
+    finally:
+        memory.close()
+
+
+
+
+class VecEnv:
+    """Many BatchEnv shards, run in parallel by worker processes
+
+    The n vehicles are split evenly into one shard per worker. The
+    observations, rewards and actions are stored in a shared memory block,
+    so that only a short command is sent to each worker per step. The API
+    equals the one of BatchEnv; the returned arrays are views of the shared
+    memory, overwritten by the next step. Call close when done.
+    """
+
+    def __init__(self, n, workers=None, track_path=None, cache_dir=None, laps=1, dt=1./tempo120.PHYSICS_HZ,
+            patch_size=PATCH_SIZE, max_steps=MAX_STEPS):
+        """Starts the workers, each loads the track
+
+        The track is compiled into the cache directory by the first one if
+        it is not cached yet.
+        """
+        workers = min(n, workers or os.cpu_count() or 1)
+        cache_dir = cache_dir if cache_dir is not None else tempo120.get_cache_dir()
+        # compiles the track once instead of in each worker
+        load_track(track_path, cache_dir)
+        self._n = n
+        _, size = get_buffers(n, patch_size)
+        self._memory = shared_memory.SharedMemory(create=True, size=size)
+        self._buffers, _ = get_buffers(n, patch_size, self._memory.buf)
+        self._connections = []
+        self._processes = []
+        bounds = np.linspace(0, n, workers+1).astype(int)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(child, self._memory.name, n, first,
+                last-first, track_path, cache_dir, laps, dt, patch_size, max_steps), daemon=True)
+            process.start()
+            self._connections.append(parent)
+            self._processes.append(process)
+        self._wait()
+
+
+    def __len__(self):
+        """Returns the number of vehicles"""
+        return self._n
+
+
+    def _send(self, command):
+        """Sends the command to all workers and waits for them"""
+        for connection in self._connections:
+            connection.send(command)
+        self._wait()
+
+
+    def _wait(self):
+        """Waits for all workers, raises the first failure"""
+        errors = [connection.recv() for connection in self._connections]
+        for error in errors:
+            if error is not None:
+                self.close()
+                raise error
+
+
+    def reset(self):
+        """Moves all vehicles to the start, returns the observations and an info dict"""
+        self._send("reset")
+        return {"state": self._buffers["state"], "patch": self._buffers["patch"]}, {}
+
+
+    def step(self, actions):
+        """Performs a simulation step of all vehicles (see BatchEnv.step)
+
+        The info dict is empty.
+        """
+        self._buffers["action"][:] = actions
+        self._send("step")
+        return {"state": self._buffers["state"], "patch": self._buffers["patch"]}, \
+            self._buffers["reward"], self._buffers["terminated"], self._buffers["truncated"], {}
+
+
+    def close(self):
+        """Stops the workers and frees the shared memory"""
+        if self._memory is None:
+            return
+        for connection, process in zip(self._connections, self._processes):
+            if process.is_alive():
+                try:
+                    connection.send("close")
+                except OSError:
+                    pass
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._buffers = None
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+# --- main function ---------------------------------------------------------
+def main(args=None):
+    """Measures the environments' throughput using random actions"""
+    parser = argparse.ArgumentParser(prog="tempo120_env",
+        description="Measures the throughput of tempo120's environments")
+    parser.add_argument("--track", default=None, help="the track to drive; gfx/track01.png by default")
+    parser.add_argument("--envs", type=int, default=1024, help="number of vehicles")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes; 0 runs a single BatchEnv")
+    parser.add_argument("--steps", type=int, default=1000, help="number of steps to perform")
+    options = parser.parse_args(args)
+
+    rng = np.random.default_rng(0)
+    actions = rng.integers(0, ACTIONS, size=(64, options.envs)).astype(np.uint8)
+    actions |= tempo120.INPUT_UP
+    if options.workers>0:
+        env = VecEnv(options.envs, options.workers, options.track)
+    else:
+        env = BatchEnv(load_track(options.track, tempo120.get_cache_dir()), options.envs)
+    try:
+        env.reset()
+        t0 = time.perf_counter()
+        reward = 0.
+        for i in range(options.steps):
+            _, rewards, _, _, _ = env.step(actions[i % len(actions)])
+            reward += float(rewards.sum())
+        duration = time.perf_counter() - t0
+    finally:
+        if options.workers>0:
+            env.close()
+    steps = options.steps * options.envs
+    print("%s steps in %.2f s: %.0f steps/s, %.1f million steps/min; mean reward %.3f" % (steps, duration,
+        steps / duration, steps / duration * 60 / 1e6, reward / steps))
+    return 0
+
+
+# -- main check
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:])) # pragma: no cover
@@ -0,0 +1,830 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+# ===========================================================================
+"""tempo120 - Races across the network."""
+# ===========================================================================
+__author__     = "Daniel Krajzewicz"
+__copyright__  = "Copyright 2023-2024, Daniel Krajzewicz"
+__credits__    = ["Daniel Krajzewicz"]
+__license__    = "GPL 3.0"
+__version__    = "1.8.0"
+__maintainer__ = "Daniel Krajzewicz"
+__email__      = "daniel@krajzewicz.de"
+__status__     = "Production"
+# ===========================================================================
+# - https://github.com/dkrajzew/tempo120
+# - http://www.krajzewicz.de
+# ===========================================================================
+
+
+# --- imports ---------------------------------------------------------------
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import asyncio
+import json
+import select
+import socket
+import struct
+import sys
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import pygame
+import tempo120
+
+
+# --- constants -------------------------------------------------------------
+PORT = 12012
+TICK_RATE = tempo120.PHYSICS_HZ
+SNAPSHOT_INTERVAL = 2
+MAX_PLAYERS = 64
+HISTORY = 64
+INPUT_REDUNDANCY = 8
+MAX_INPUT_QUEUE = 16
+CLIENT_TIMEOUT = 10.
+CONNECT_TIMEOUT = 3.
+SNAPSHOT_TIMEOUT = 3.
+MAX_LAG = .25
+INTERPOLATION_TICKS = 2 * SNAPSHOT_INTERVAL
+BENCH_PLAYERS = [1, 2, 4, 8, 16, 32, 64]
+
+POSITION_SCALE = 8.
+ANGLE_SCALE = 65536 / 360.
+SPEED_SCALE = 256.
+TURN_SCALE = 4.
+FIELDS = 6
+STATUS_ACTIVE = 0x80
+STATUS_FINISHED = 0x40
+STATUS_LAP = 0x3f
+
+MSG_JOIN = b"J"
+MSG_WELCOME = b"W"
+MSG_INPUT = b"I"
+MSG_ACK = b"A"
+MSG_LEAVE = b"L"
+MSG_SNAPSHOT = b"S"
+WELCOME_HEADER = "<cBHH"
+INPUT_HEADER = "<cIIB"
+ACK_HEADER = "<cI"
+SNAPSHOT_HEADER = "<cIII"
+
+
+# --- helper methods --------------------------------------------------------
+def write_varint(data, value):
+    """Appends the (signed) value zigzag- and varint-encoded to the bytearray"""
+    value = value << 1 if value>=0 else (-value << 1) - 1
+    while value>=0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def read_varint(data, offset):
+    """Returns the (signed) value stored at the offset and the offset behind it"""
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte<0x80:
+            break
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+
+
+def quantise(vehicle, lap, finished):
+    """Returns the vehicle's state as integers (see FIELDS)
+
+    The position is stored in 1/8 pixels, the orientation in 1/65536 of a
+    circle, the velocity in 1/256 and the turning in 1/4 units.
+    """
+    status = STATUS_ACTIVE | (STATUS_FINISHED if finished else 0) | min(lap, STATUS_LAP)
+    return (int(round(vehicle._x * POSITION_SCALE)), int(round(vehicle._y * POSITION_SCALE)),
+        int(round((vehicle._o % 360) * ANGLE_SCALE)) % 65536, int(round(vehicle._v * SPEED_SCALE)),
+        int(round(vehicle._do * TURN_SCALE)), status)
+
+
+def dequantise(state):
+    """Returns the position, orientation, velocity and turning of a quantised state"""
+    return (state[0] / POSITION_SCALE, state[1] / POSITION_SCALE, state[2] / ANGLE_SCALE,
+        state[3] / SPEED_SCALE, state[4] / TURN_SCALE)
+
+
+def encode_delta(state, base):
+    """Encodes the differences of the state (an array of quantised vehicle states) to the base
+
+    Only changed vehicles are written: the slot, a byte flagging the changed
+    fields and the fields' differences as varints.
+    """
+    data = bytearray()
+    for slot in np.nonzero((state!=base).any(axis=1))[0]:
+        diff = (state[slot] - base[slot]).tolist()
+        data.append(slot)
+        mask = len(data)
+        data.append(0)
+        for field, value in enumerate(diff):
+            if value:
+                data[mask] |= 1 << field
+                write_varint(data, value)
+    return bytes(data)
+
+
+def decode_delta(data, offset, base):
+    """Applies the differences stored from the offset on to a copy of the base"""
+    state = base.copy()
+    while offset<len(data):
+        slot = data[offset]
+        mask = data[offset+1]
+        offset += 2
+        for field in range(FIELDS):
+            if mask & (1 << field):
+                value, offset = read_varint(data, offset)
+                state[slot, field] += value
+    return state
+
+
+def parse_address(address, port=PORT):
+    """Returns (host, port) of an address given as host[:port]"""
+    host, _, value = address.partition(":")
+    return host or "127.0.0.1", int(value) if value else port
+
+
+def find_track(name):
+    """Returns the path of the game's track (an image or a tiled track file) of the given name
+
+    Returns None if there is no such track.
+    """
+    for extension in (".png", ".t120"):
+        path = os.path.join(tempo120.get_data_path(), "gfx", os.path.basename(name) + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+# --- classes ---------------------------------------------------------------
+class RemotePlayer:
+    """A client as seen by the server"""
+
+    def __init__(self, address, slot, name):
+        """Initialises the player"""
+        self._address = address
+        self._slot = slot
+        self._name = name
+        self._inputs = deque()
+        self._queued = 0
+        self._processed = 0
+        self._last_input = 0
+        self._ack = 0
+        self._last_seen = time.monotonic()
+        self._started = None
+        self._reported = False
+
+
+
+
+class Server(asyncio.DatagramProtocol):
+    """An authoritative race server
+
+    The server runs the simulation at a fixed tick rate. Each client's
+    vehicle is driven by the inputs the client sends; each input packet
+    holds the last INPUT_REDUNDANCY inputs, numbered, so that lost packets
+    do not lose inputs. One input is used per tick, the last one is repeated
+    if none arrived in time.
+
+    Every snapshot_interval ticks, each client gets a snapshot of all
+    vehicles: their quantised states (see quantise), encoded as the
+    differences to the last snapshot the client acknowledged (see
+    encode_delta), together with the number of the last input used. The
+    differences to a snapshot are encoded once for all clients that
+    acknowledged it. Clients that do not race acknowledge the snapshots
+    without inputs; clients that send nothing for CLIENT_TIMEOUT seconds
+    are removed.
+    """
+
+    def __init__(self, track, track_name=tempo120.DEFAULT_TRACK, tick_rate=TICK_RATE, laps=1,
+            max_players=MAX_PLAYERS, snapshot_interval=SNAPSHOT_INTERVAL, verbose=False):
+        """Initialises the server"""
+        self._track = track
+        self._track_name = track_name
+        self._tick_rate = tick_rate
+        self._laps = laps
+        self._snapshot_interval = snapshot_interval
+        self._verbose = verbose
+        self._simulation = tempo120.Simulation(track, 1. / tick_rate, laps)
+        self._slots = [None] * min(max_players, 255)
+        self._clients = {}
+        self._tick = 0
+        self._history = OrderedDict()
+        self._empty = np.zeros((len(self._slots), FIELDS), dtype=np.int64)
+        self._transport = None
+        self._received = 0
+        self._bytes_sent = 0
+        self._packets_sent = 0
+
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+
+    def get_start_position(self, slot):
+        """Returns the position a player starts at, in rows of four beside and behind the start"""
+        x, y = self._track.get_next_starting_position()
+        px = x + (0, 1, -1, 2)[slot % 4] * tempo120.PLAYER_GAP
+        py = y + slot // 4 * tempo120.PLAYER_GAP
+        if self._track.get_floor(px, py) in tempo120.DISTANCE_FLOORS:
+            return x, y
+        return px, py
+
+
+    def datagram_received(self, data, address):
+        self._received += 1
+        kind = data[:1]
+        player = self._clients.get(address)
+        try:
+            if kind==MSG_JOIN:
+                self.join(address, data[1:].decode("utf-8", "replace"))
+            elif player is None:
+                return
+            elif kind==MSG_INPUT:
+                _, ack, last, count = struct.unpack_from(INPUT_HEADER, data)
+                inputs = data[struct.calcsize(INPUT_HEADER):][:count]
+                for seq, value in enumerate(inputs, last-len(inputs)+1):
+                    if seq>player._queued:
+                        player._inputs.append((seq, value & 0xf))
+                        player._queued = seq
+                while len(player._inputs)>MAX_INPUT_QUEUE:
+                    player._inputs.popleft()
+                player._ack = ack
+                player._last_seen = time.monotonic()
+            elif kind==MSG_ACK:
+                _, ack = struct.unpack_from(ACK_HEADER, data)
+                player._ack = ack
+                player._last_seen = time.monotonic()
+            elif kind==MSG_LEAVE:
+                self.leave(player)
+        except struct.error:
+            pass
+
+
+    def join(self, address, name):
+        """Adds a player or restarts the race of a known one
+
+        Answers with the player's slot, which is 255 if the server is full.
+        """
+        player = self._clients.get(address)
+        if player is None:
+            if None not in self._slots:
+                welcome = struct.pack(WELCOME_HEADER, MSG_WELCOME, 255, self._tick_rate, self._laps)
+                self._transport.sendto(welcome, address)
+                return
+            slot = self._slots.index(None)
+            player = RemotePlayer(address, slot, name)
+            self._slots[slot] = player
+            self._clients[address] = player
+        slot = player._slot
+        x, y = self.get_start_position(slot)
+        vehicles = self._simulation._vehicles
+        while len(vehicles)<=slot:
+            self._simulation.add_vehicle(tempo120.Vehicle(x, y, 180, None))
+        self._simulation.reset_vehicle(slot, x, y)
+        player._inputs.clear()
+        player._last_input = 0
+        player._started = None
+        player._reported = False
+        player._last_seen = time.monotonic()
+        self._transport.sendto(struct.pack(WELCOME_HEADER, MSG_WELCOME, slot, self._tick_rate, self._laps)
+            + self._track_name.encode("utf-8"), address)
+        if self._verbose:
+            print("%s joined from %s:%s" % (name or "player %s" % slot, address[0], address[1]))
+
+
+    def leave(self, player):
+        """Removes the player"""
+        self._slots[player._slot] = None
+        del self._clients[player._address]
+        if self._verbose:
+            print("%s left" % (player._name or "player %s" % player._slot))
+
+
+    def tick(self):
+        """Performs a simulation step and sends the snapshots if due"""
+        self._tick += 1
+        now = time.monotonic()
+        inputs = []
+        for slot in range(len(self._simulation._vehicles)):
+            player = self._slots[slot]
+            if player is not None and now-player._last_seen>CLIENT_TIMEOUT:
+                self.leave(player)
+                player = None
+            if player is None:
+                inputs.append(0)
+                continue
+            if player._inputs:
+                player._processed, player._last_input = player._inputs.popleft()
+                if player._started is None:
+                    player._started = self._simulation._time
+            inputs.append(player._last_input)
+        self._simulation.step(inputs)
+        state = self._empty.copy()
+        for slot, player in enumerate(self._slots):
+            if player is None or slot>=len(self._simulation._vehicles):
+                continue
+            finish_time = self._simulation.get_finish_time(slot)
+            state[slot] = quantise(self._simulation._vehicles[slot], self._simulation._lap[slot],
+                finish_time is not None)
+            if finish_time is not None and not player._reported:
+                player._reported = True
+                if self._verbose:
+                    print("%s finished in %s" % (player._name or "player %s" % slot,
+                        tempo120.nice_time(finish_time - (player._started or 0))))
+        self._history[self._tick] = state
+        while len(self._history)>HISTORY:
+            self._history.popitem(last=False)
+        if self._tick % self._snapshot_interval==0:
+            self.send_snapshots(state)
+
+
+    def send_snapshots(self, state):
+        """Sends the current state to all clients, relative to the snapshot each acknowledged"""
+        bodies = {}
+        for player in list(self._clients.values()):
+            base = player._ack if player._ack in self._history else 0
+            body = bodies.get(base)
+            if body is None:
+                body = bodies[base] = encode_delta(state, self._history[base] if base else self._empty)
+            packet = struct.pack(SNAPSHOT_HEADER, MSG_SNAPSHOT, self._tick, base, player._processed) + body
+            self._transport.sendto(packet, player._address)
+            self._bytes_sent += len(packet)
+            self._packets_sent += 1
+
+
+    async def run(self, duration=None):
+        """Ticks at the tick rate, forever or for the given duration in seconds
+
+        If the server falls behind by more than MAX_LAG, the missed ticks are
+        skipped.
+        """
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        end = None if duration is None else next_time + duration
+        while end is None or loop.time()<end:
+            self.tick()
+            next_time += 1. / self._tick_rate
+            delay = next_time - loop.time()
+            if delay<-MAX_LAG:
+                next_time = loop.time()
+            await asyncio.sleep(max(0, delay))
+
+
+
+
+class Client:
+    """A connection to a Server
+
+    The client uses a non-blocking socket and is polled, so that it fits
+    into the game's loop. It keeps the inputs the server did not use yet
+    for predicting the own vehicle and the last snapshots for interpolating
+    the other ones.
+    """
+
+    def __init__(self, address, name=""):
+        """Opens the socket"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._socket.connect(address)
+        self._name = name
+        self._slot = None
+        self._tick_rate = TICK_RATE
+        self._laps = 1
+        self._track_name = None
+        self._seq = 0
+        self._pending = deque()
+        self._snapshots = OrderedDict()
+        self._latest = 0
+        self._bytes_received = 0
+
+
+    def join(self):
+        """Asks the server to add the player or to restart the player's race"""
+        self._send(MSG_JOIN + self._name.encode("utf-8"))
+
+
+    def rejoin(self):
+        """Forgets the received snapshots and joins again
+
+        Used if the server stopped sending snapshots, e.g. because it removed
+        the player or was restarted and counts its ticks anew.
+        """
+        self._snapshots.clear()
+        self._latest = 0
+        self.join()
+
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Joins and waits for the server's answer
+
+        Raises a ConnectionError if the server does not answer or is full.
+        """
+        self.join()
+        end = time.monotonic() + timeout
+        while self._slot is None and time.monotonic()<end:
+            select.select([self._socket], [], [], max(0, end - time.monotonic()))
+            self.poll()
+        if self._slot is None:
+            raise ConnectionError("The server does not answer.")
+        if self._slot==255:
+            raise ConnectionError("The server is full.")
+
+
+    def leave(self):
+        """Tells the server that the player left"""
+        self._send(MSG_LEAVE)
+
+
+    def close(self):
+        """Closes the socket"""
+        self._socket.close()
+
+
+    def _send(self, data):
+        try:
+            self._socket.send(data)
+        except OSError:
+            pass
+
+
+    def send_inputs(self, inputs):
+        """Sends the inputs of the next tick, together with the previous unused ones"""
+        self._seq += 1
+        self._pending.append((self._seq, inputs))
+        values = bytes(value for _, value in list(self._pending)[-INPUT_REDUNDANCY:])
+        self._send(struct.pack(INPUT_HEADER, MSG_INPUT, self._latest, self._seq, len(values)) + values)
+
+
+    def send_ack(self):
+        """Acknowledges the latest snapshot without sending inputs, keeping the connection alive"""
+        self._send(struct.pack(ACK_HEADER, MSG_ACK, self._latest))
+
+
+    def poll(self):
+        """Reads the received packets, returns the number of new snapshots"""
+        received = 0
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except OSError:
+                break
+            self._bytes_received += len(data)
+            try:
+                received += self.handle(data)
+            except (struct.error, IndexError):
+                pass
+        return received
+
+
+    def handle(self, data):
+        """Processes a packet, returns whether it was a new snapshot"""
+        kind = data[:1]
+        if kind==MSG_WELCOME:
+            _, self._slot, self._tick_rate, self._laps = struct.unpack_from(WELCOME_HEADER, data)
+            self._track_name = data[struct.calcsize(WELCOME_HEADER):].decode("utf-8", "replace")
+        elif kind==MSG_SNAPSHOT:
+            _, tick, base, processed = struct.unpack_from(SNAPSHOT_HEADER, data)
+            if tick<=self._latest or (base and base not in self._snapshots):
+                return 0
+            base_state = self._snapshots[base] if base else np.zeros((256, FIELDS), dtype=np.int64)
+            self._snapshots[tick] = decode_delta(data, struct.calcsize(SNAPSHOT_HEADER), base_state)
+            while len(self._snapshots)>HISTORY:
+                self._snapshots.popitem(last=False)
+            self._latest = tick
+            while self._pending and self._pending[0][0]<=processed:
+                self._pending.popleft()
+            return 1
+        return 0
+
+
+    def get_state(self, slot, tick=None):
+        """Returns the quantised state of the vehicle in the given (the latest) snapshot
+
+        Returns None if the vehicle is not in the race.
+        """
+        state = self._snapshots.get(self._latest if tick is None else tick)
+        if state is None or not state[slot, 5] & STATUS_ACTIVE:
+            return None
+        return state[slot]
+
+
+    def get_slots(self):
+        """Returns the slots of the vehicles in the race (besides the own one)"""
+        state = self._snapshots.get(self._latest)
+        if state is None:
+            return []
+        return [slot for slot in np.nonzero(state[:, 5] & STATUS_ACTIVE)[0] if slot!=self._slot]
+
+
+    def get_interpolated(self, slot, tick):
+        """Returns the vehicle's position and orientation at the given (fractional) tick
+
+        The position is interpolated between the snapshots before and after
+        the tick. Returns None if the vehicle is not in the race.
+        """
+        before = after = None
+        for t in self._snapshots:
+            if t<=tick:
+                before = t
+            elif after is None:
+                after = t
+        if before is None:
+            before = after
+        a = self.get_state(slot, before)
+        if a is None:
+            return None
+        x, y, o = dequantise(a)[:3]
+        b = self.get_state(slot, after) if after is not None else None
+        if b is None or after==before:
+            return x, y, o
+        alpha = (tick - before) / float(after - before)
+        bx, by, bo = dequantise(b)[:3]
+        do = (bo - o + 180) % 360 - 180
+        return x + (bx - x) * alpha, y + (by - y) * alpha, o + do * alpha
+
+
+
+
+class NetGame(tempo120.Game):
+    """The game, racing on a server
+
+    The own vehicle is predicted: it is driven by the local inputs at once
+    and, whenever a snapshot arrives, set to the server's state and driven
+    by the inputs the server did not use yet again. The other players'
+    vehicles are shown INTERPOLATION_TICKS behind the last snapshot,
+    interpolated between the snapshots. Network races are not added to the
+    scores.
+
+    If no snapshot arrives for SNAPSHOT_TIMEOUT seconds, the game joins the
+    server again.
+    """
+
+    def __init__(self, options, client):
+        """Initialises the game using a connected client"""
+        self._client = client
+        self._remote = {}
+        self._since_snapshot = 0
+        self._lost = False
+        options.no_ghost = True
+        options.opponents = 0
+        options.players = 1
+        super().__init__(options)
+
+
+    def init(self):
+        """Initialises a game run and (re)starts the race on the server"""
+        super().init()
+        self._client.rejoin()
+        self._remote = {}
+
+
+    def process_keys(self, dt):
+        """Processes the key inputs and sends them to the server while racing
+
+        In the other states, the snapshots are acknowledged only, so that the
+        server keeps the player.
+        """
+        inputs = super().process_keys(dt)
+        if self._state==tempo120.GAME:
+            self._client.send_inputs(inputs[0])
+        else:
+            self._client.send_ack()
+        return inputs
+
+
+    def step(self, dt):
+        """Performs a simulation step and corrects the prediction"""
+        super().step(dt)
+        if self._state==tempo120.LOADING:
+            return
+        self._since_snapshot += 1
+        if self._client.poll():
+            if self._lost:
+                print("Joined the server again.", file=sys.stderr)
+                self._lost = False
+            self._since_snapshot = 0
+            self.reconcile(dt)
+        elif self._since_snapshot>=SNAPSHOT_TIMEOUT * self._client._tick_rate:
+            self.reconnect()
+
+
+    def reconnect(self):
+        """Joins the server again after no snapshot arrived for SNAPSHOT_TIMEOUT seconds
+
+        A running race is restarted, as the server starts it anew.
+        """
+        if not self._lost:
+            print("The server does not answer, joining again.", file=sys.stderr)
+            self._lost = True
+        self._since_snapshot = 0
+        if self._state in (tempo120.BEGIN, tempo120.GAME):
+            self.init()
+        else:
+            self._client.rejoin()
+
+
+    def reconcile(self, dt):
+        """Sets the own vehicle to the server's state and applies the unused inputs again"""
+        state = self._client.get_state(self._client._slot)
+        if state is None:
+            return
+        ego = self._ego
+        x, y, o, v, do = dequantise(state)
+        if self._state not in (tempo120.GAME, tempo120.SET_SCORE):
+            self._simulation.reset_vehicle(0, x, y, o)
+            return
+        ego._x, ego._y, ego._o, ego._v, ego._do = x, y, o, v, do
+        for _, inputs in self._client._pending:
+            ego.control(dt, inputs)
+            ego.step(self._track, dt)
+
+
+    def draw(self, surface, alpha=1.):
+        """Moves the other players' vehicles to their interpolated positions and draws the game"""
+        client = self._client
+        tick = min(client._latest, client._latest - INTERPOLATION_TICKS + self._since_snapshot + alpha)
+        remote = {}
+        for slot in client.get_slots():
+            position = client.get_interpolated(slot, tick)
+            if position is None:
+                continue
+            vehicle = self._remote.get(slot)
+            if vehicle is None:
+                vehicle = tempo120.Vehicle(0, 0, 0, self._car_image, self._npc_sprites)
+            vehicle._x, vehicle._y, vehicle._o = position
+            vehicle._prev_state = position
+            remote[slot] = vehicle
+        self._remote = remote
+        return super().draw(surface, alpha)
+
+
+    def draw_view(self, surface, alpha, view, index):
+        """Draws the other players' vehicles below the own one and the texts"""
+        rects = []
+        if self._state in (tempo120.BEGIN, tempo120.GAME, tempo120.SET_SCORE):
+            for vehicle in self._remote.values():
+                rects.append(vehicle.draw(surface, 1., view, self._scale))
+        return rects + super().draw_view(surface, alpha, view, index)
+
+
+    def save_score(self):
+        """Network races are not added to the scores"""
+        return
+
+
+
+
+# --- benchmark -------------------------------------------------------------
+async def bench_server(track, players, ticks, snapshot_interval=SNAPSHOT_INTERVAL):
+    """Measures a server's ticks with the given number of clients on localhost
+
+    The clients send random inputs each tick and acknowledge the snapshots.
+    Returns the median duration of a tick in ms and the bytes sent per tick.
+    """
+    loop = asyncio.get_running_loop()
+    server = Server(track, max_players=max(players, 1), snapshot_interval=snapshot_interval)
+    transport, _ = await loop.create_datagram_endpoint(lambda: server, local_addr=("127.0.0.1", 0))
+    try:
+        address = transport.get_extra_info("sockname")
+        clients = [Client(address, "bench%s" % i) for i in range(players)]
+        for client in clients:
+            client.join()
+        while any(client._slot is None for client in clients):
+            await asyncio.sleep(.001)
+            for client in clients:
+                client.poll()
+        rng = np.random.default_rng(0)
+        durations = []
+        sent = server._bytes_sent
+        for i in range(ticks):
+            received = server._received + players
+            for client in clients:
+                client.send_inputs(int(rng.integers(0, 16)) | tempo120.INPUT_UP)
+            while server._received<received:
+                await asyncio.sleep(0)
+            t0 = time.perf_counter()
+            server.tick()
+            durations.append((time.perf_counter() - t0) * 1000.)
+            await asyncio.sleep(0)
+            for client in clients:
+                client.poll()
+        for client in clients:
+            client.close()
+        return float(np.median(durations)), (server._bytes_sent - sent) / float(ticks)
+    finally:
+        transport.close()
+
+
+def bench(track, players, ticks, tick_rate=TICK_RATE):
+    """Prints the tick durations and the bandwidth for the numbers of players
+
+    Returns the results as a dict.
+    """
+    results = {}
+    print("%8s %10s %12s %14s" % ("players", "ms/tick", "bytes/tick", "bytes/player"))
+    for n in players:
+        duration, sent = asyncio.run(bench_server(track, n, ticks))
+        results[n] = {"ms_per_tick": duration, "bytes_per_tick": sent}
+        print("%8s %10.3f %12.1f %14.1f" % (n, duration, sent, sent / n))
+    n = max(results)
+    load = results[n]["ms_per_tick"] * tick_rate / 10.
+    print("%s players use %.1f%% of a core at %s ticks/s, each receiving %.1f kB/s" % (n, load, tick_rate,
+        results[n]["bytes_per_tick"] / n * tick_rate / 1000.))
+    return results
+
+
+# --- main function ---------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="tempo120_net", description="Races tempo120 across the network",
+        epilog="Further options are passed to the game when connecting.")
+    parser.add_argument("--server", action="store_true", help="run a server")
+    parser.add_argument("--connect", default=None, metavar="HOST[:PORT]",
+                        help="join the race on the given server")
+    parser.add_argument("--bench", action="store_true",
+                        help="measure a server's load on localhost and exit")
+    parser.add_argument("--port", type=int, default=PORT, help="the port the server listens at")
+    parser.add_argument("--name", default="", help="the player's name shown by the server")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE,
+                        help="simulation steps per second of the server")
+    parser.add_argument("--max-players", type=int, default=MAX_PLAYERS,
+                        help="maximum number of players of the server")
+    parser.add_argument("--bench-players", default=",".join(str(n) for n in BENCH_PLAYERS),
+                        help="comma separated numbers of players to benchmark")
+    parser.add_argument("--bench-ticks", type=int, default=300, help="number of ticks to benchmark")
+    parser.add_argument("--output", default=None,
+                        help="write the benchmark's results as JSON into this file")
+    options, game_args = parser.parse_known_args(args)
+    game_options = tempo120.parse_options(game_args)
+
+    if options.connect:
+        client = Client(parse_address(options.connect, options.port), options.name)
+        try:
+            client.connect()
+        except ConnectionError as e:
+            print(e, file=sys.stderr)
+            return 1
+        track_path = game_options.track or os.path.join(tempo120.get_data_path(), "gfx", "track01.png")
+        if os.path.splitext(os.path.basename(track_path))[0]!=client._track_name:
+            # the own track is searched among the game's ones
+            track_path = find_track(client._track_name)
+            if track_path is None:
+                print("The server races on '%s', which is not available." % client._track_name,
+                    file=sys.stderr)
+                client.leave()
+                client.close()
+                return 1
+            game_options.track = track_path
+        game_options.physics_hz = client._tick_rate
+        game_options.laps = client._laps
+        pygame.init()
+        pygame.mixer.init()
+        surface = tempo120.open_display(game_options)
+        tempo120.run(NetGame(game_options, client), surface, game_options)
+        client.leave()
+        client.close()
+        pygame.mixer.quit()
+        return 0
+
+    track_path = game_options.track or os.path.join(tempo120.get_data_path(), "gfx", "track01.png")
+    cache_dir = None if game_options.no_cache else game_options.cache_dir
+    track = tempo120.load_track(track_path, cache_dir=cache_dir)
+    if options.bench:
+        players = [int(n) for n in options.bench_players.split(",") if n]
+        results = bench(track, players, options.bench_ticks, options.tick_rate)
+        if options.output:
+            with open(options.output, "w") as fd:
+                json.dump(results, fd, indent=1, sort_keys=True)
+        return 0
+    if options.server:
+        track_name = os.path.splitext(os.path.basename(track_path))[0]
+        server = Server(track, track_name, options.tick_rate, game_options.laps, options.max_players,
+            verbose=True)
+        async def serve():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(lambda: server,
+                local_addr=("0.0.0.0", options.port))
+            print("Serving '%s' at port %s" % (track_name, options.port))
+            try:
+                await server.run()
+            finally:
+                transport.close()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+    parser.print_help()
+    return 1
+
+
+# -- main check
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:])) # pragma: no cover